@@ -1,3 +1,4 @@
+import logging
 import math
 import os
 import random
@@ -9,7 +10,14 @@ from time import time
 
 from recordclass import recordclass
 
+import Checkpoint
 import GlobalFunctions as gl
+import IncrementalEvaluation as ie
+import ParallelEvaluation as pe
+import Surrogate
+from RunProfile import RunProfile
+
+logger = logging.getLogger(__name__)
 
 Schedule = recordclass('Schedule', [
     'i_intersection',
@@ -50,6 +58,9 @@ class Patch:
         self.stgLim = 0
         self.employees = 0
         self.stg = True
+        self.trace = None
+        # score of the scout at the recruits' grading fidelity, when that is not full
+        self.screen_score = None
 
 
 def changeGreenTimeDuration(schedule, numberOfIntersection, numberOfRoads, limit_on_minimum_green_phase_duration,
@@ -86,7 +97,7 @@ def changeGreenTimeDuration(schedule, numberOfIntersection, numberOfRoads, limit
                     intersectionCycle += x
                 if (intersectionCycle >= limit_on_minimum_cycle_length and intersectionCycle <= limit_on_maximum_cycle_length):
                     break
-                print("Phase Green Time Boundaries Not Correct - Change Green Time")
+                logger.debug("Phase Green Time Boundaries Not Correct - Change Green Time")
                 if (i == loop_upper_limit - 1):
                     schedule[rand].green_times[schedule[rand].order[semaforId]] = initial
             otherCount += 1
@@ -111,11 +122,10 @@ def shuffleOrder(schedules, numberOfIntersection, intersections, name_to_i_stree
 
 def shuffleSingleOrder(schedule, intersections, name_to_i_street):
     random.shuffle(schedule.order)
-    if 'signal_phase_order' in intersections[schedule.i_intersection].constraints:
+    if intersections[schedule.i_intersection].phase_order:
         if (not gl.assertOrderPhaseForSchedule(schedule, intersections, name_to_i_street)):
             rand_index = 0
-            for street in intersections[schedule.i_intersection].constraints['signal_phase_order']:
-                street_id = name_to_i_street.get(street).id
+            for street_id in intersections[schedule.i_intersection].phase_order:
                 index = schedule.order.index(street_id)
                 temp_val = schedule.order[rand_index]
                 schedule.order[rand_index] = schedule.order[index]
@@ -148,11 +158,13 @@ def swapOrder(schedules, numberOfIntersections, intersections, name_to_i_street)
                 break
             if (i == upper_loop_limit - 1):
                 schedules[rand].order = initial_order
-        print("Phase Order Not Correct - Swap - Initial Order Returned")
+        logger.debug("Phase Order Not Correct - Swap - Initial Order Returned")
     return schedules
 
 
 def copyScheduleArray(scheduleArr):
+    if isinstance(scheduleArr, gl.ScheduleArray):
+        return scheduleArr.copy()
     newScheduleArr = []
     for i in range(0, len(scheduleArr)):
         newScheduleArr.append(
@@ -166,9 +178,17 @@ def copyScheduleArray(scheduleArr):
 
 def traffic_based_initial_solution(intersections: list[gl.Intersection], limit_on_minimum_green_phase_duration: int,
                                    limit_on_maximum_green_phase_duration: int, limit_on_minimum_cycle_length: int,
-                                   limit_on_maximum_cycle_length: int, name_to_i_street) -> list[Schedule]:
+                                   limit_on_maximum_cycle_length: int, name_to_i_street,
+                                   state: gl.SimulationState = None) -> list[Schedule]:
+    # traffic is read from the state of a previous simulation, without one every street counts as empty
+    def num_waiting_cars(street):
+        return len(state.waiting_cars[street.id]) if state is not None else 0
+
+    def num_driving_cars(street):
+        return len(state.driving_cars[street.id]) if state is not None else 0
+
     schedules = []
-    all_waiting_cars = [len(street.waiting_cars) for intersection in intersections for street in intersection.incomings]
+    all_waiting_cars = [num_waiting_cars(street) for intersection in intersections for street in intersection.incomings]
     threshold = sum(all_waiting_cars) / len(all_waiting_cars)
 
     for intersection in intersections:
@@ -186,7 +206,7 @@ def traffic_based_initial_solution(intersections: list[gl.Intersection], limit_o
                 for group in intersection.constraints['simultaneously_signal']:
                     if street in group:
                         street_obj = name_to_i_street.get(street)
-                        street_group_traffic[group[0]] += len(street_obj.driving_cars) + len(street_obj.waiting_cars)
+                        street_group_traffic[group[0]] += num_driving_cars(street_obj) + num_waiting_cars(street_obj)
             sorted_streets = sorted(streets, key=lambda s: street_group_traffic.get(s.name, 0), reverse=True)
         else:
             sorted_streets = []
@@ -194,7 +214,7 @@ def traffic_based_initial_solution(intersections: list[gl.Intersection], limit_o
             order.append(street.id)
             random_factor = random.uniform(limit_on_minimum_green_phase_duration,
                                            limit_on_maximum_green_phase_duration)
-            green_time = 2 if len(street.waiting_cars) > threshold else 1
+            green_time = 2 if num_waiting_cars(street) > threshold else 1
             green_times[street.id] = int(green_time * random_factor)
             total_green_time += green_times[street.id]
         total_green_time = min(max(total_green_time, limit_on_minimum_cycle_length), limit_on_maximum_cycle_length)
@@ -234,13 +254,14 @@ def usage_based_initial_solution(intersections: list[gl.Intersection], limit_on_
                 for group in intersection.constraints['simultaneously_signal']:
                     if street in group:
                         street_group_usage[group[0]] += intersection.streets_usage.get(street.name, 0)
-            intersection.streets_usage = street_group_usage
-            sorted_streets = sorted(streets, key=lambda s: intersection.streets_usage.get(s.name, 0), reverse=True)
+            # kept local, the parsed instance may be shared with other runs
+            streets_usage = street_group_usage
+            sorted_streets = sorted(streets, key=lambda s: streets_usage.get(s.name, 0), reverse=True)
         else:
             sorted_streets = []
         for street in sorted_streets:
             order.append(street.id)
-            usage = intersection.streets_usage.get(street.name, 0)
+            usage = streets_usage.get(street.name, 0)
             green_time = min(max(limit_on_minimum_green_phase_duration, int(math.sqrt(usage))),
                              limit_on_maximum_green_phase_duration)
             green_times[street.id] = green_time
@@ -276,19 +297,19 @@ def generateSolution(intersections, name_to_i_street, limit_on_minimum_green_pha
         schedule = solution[i]
         while (not gl.assertOrderPhaseForSchedule(schedule, intersections, name_to_i_street)):
             solution[i] = shuffleSingleOrder(schedule, intersections, name_to_i_street)
-            print("Phase Order Not Correct - Generate Solution")
+            logger.debug("Phase Order Not Correct - Generate Solution")
     return solution
 
 
 def writeOutputToFile(patches, executionTime, countIterations, ns, nb, ne, nrb, nre, stgLim, initialShrinkageFactor,
-                      shrinkageFactorReducedBy, shrinkageFactor, start, file, streets, intersections):
+                      shrinkageFactorReducedBy, shrinkageFactor, start, file, streets, intersections, profile=None):
     code = "".join(random.choices(string.ascii_lowercase, k=3))
     output_path = file
 
     outputJSON1  = gl.getPrintedSchedule(patches[0].scout, streets=streets)
 
     outputJSON = gl.print_json_solution(patches=patches, schedules=patches[0].scout, streets=streets, intersections=intersections,
-                           file=outputJSON1, code=code)
+                           file=outputJSON1, code=code, profile=profile)
     
     return outputJSON
 
@@ -297,8 +318,121 @@ def writeOutputToFile(patches, executionTime, countIterations, ns, nb, ne, nrb,
 def BeeHive(streets, intersections, paths, total_duration, bonus_points, terminated_time, yellow_phase,
             name_to_i_street, limit_on_minimum_green_phase_duration, limit_on_maximum_green_phase_duration,
             limit_on_minimum_cycle_length, limit_on_maximum_cycle_length, duration_to_pass_through_a_traffic_light,
-            i_id_to_intersection, output_file_path, use_seed=False, solution_file_path=None, execution_time=10):
-    print(limit_on_minimum_cycle_length)
+            i_id_to_intersection, output_file_path, use_seed=False, solution_file_path=None, execution_time=10,
+            engine='python', incremental=False, cache_size=10000, workers=0, migrate=None, progress=None,
+            cohorts=False, early_abort=False, screening=1, fidelity='full', checkpoint_path=None,
+            checkpoint_interval=60, resume=None):
+    logger.debug("Minimum cycle length: %s", limit_on_minimum_cycle_length)
+    fidelity = gl.fidelity_level(fidelity)
+    # Packed once, so that the setup of per-car grading (CarPaths.grade_setup) is built once per run.
+    paths = gl.CarPaths.from_paths(streets, paths)
+    profile = RunProfile()
+    fitness_cache = gl.FitnessCache(cache_size)
+    # With screening > 1 every patch draws screening times as many recruited bees and the surrogate picks the
+    # ones that get simulated.
+    surrogate = None
+    if screening > 1:
+        surrogate = Surrogate.DelaySurrogate(streets, intersections, paths, total_duration, yellow_phase,
+                                             duration_to_pass_through_a_traffic_light)
+    evaluator = None
+    if workers > 1:
+        evaluator = pe.ParallelEvaluator(workers, (streets, intersections, paths, total_duration, bonus_points,
+                                                   yellow_phase, duration_to_pass_through_a_traffic_light),
+                                         engine=engine, incremental=incremental, cohorts=cohorts)
+
+    def cache_key(schedule, fidelity):
+        # Results below full fidelity are only estimates, they are cached apart from the exact ones.
+        key = gl.schedule_fingerprint(schedule)
+        if gl.is_full_fidelity(fidelity):
+            return key
+        level = gl.fidelity_level(fidelity)
+        return key, level.horizon, level.sample
+
+    def parent_cutoff(parent, fidelity):
+        # A recruited bee only matters if it beats its parent, hopeless ones stop early. Off by default: the bound
+        # of grade(cutoff=...) is too loose to make that pay off, see its docstring.
+        if not early_abort or parent is None:
+            return None
+        return parent.score if gl.is_full_fidelity(fidelity) else parent.screen_score
+
+    def evaluate(schedule, parent=None, fidelity='full'):
+        # Identical schedules are graded once, the simulation is deterministic.
+        key = cache_key(schedule, fidelity)
+        result = fitness_cache.get(key)
+        if result is not None:
+            return result
+        if incremental and parent is not None and gl.is_full_fidelity(fidelity):
+            # Re-simulate only what the move changed, relative to the recorded parent patch.
+            if parent.trace is None:
+                parent.trace = ie.trace_schedule(parent.scout, streets, intersections, paths, total_duration,
+                                                 bonus_points, yellow_phase, duration_to_pass_through_a_traffic_light)
+            profile.count('simulations')
+            with profile.timer('grade_incremental'):
+                result = ie.grade_incremental(parent.trace, schedule)
+        else:
+            profile.count('simulations')
+            with profile.timer('grade'):
+                result = gl.grade(schedule, streets, intersections, paths, total_duration, bonus_points,
+                                  yellow_phase, duration_to_pass_through_a_traffic_light, engine=engine,
+                                  cohorts=cohorts, cutoff=parent_cutoff(parent, fidelity), fidelity=fidelity)
+        if isinstance(result, gl.CutoffResult):
+            # only a bound of the score, not cached
+            profile.count('aborted')
+            return result
+        fitness_cache.put(key, result)
+        return result
+
+    def evaluate_batch(schedules, parents=None, fidelity='full'):
+        nonlocal evaluations
+        evaluations += len(schedules)
+        profile.count('evaluations', len(schedules))
+        if parents is None:
+            parents = [None] * len(schedules)
+        if evaluator is None and incremental and gl.is_full_fidelity(fidelity):
+            return [evaluate(schedule, parent, fidelity) for schedule, parent in zip(schedules, parents)]
+        keys = [cache_key(schedule, fidelity) for schedule in schedules]
+        results = [fitness_cache.get(key) for key in keys]
+        pending = {}
+        for index, key in enumerate(keys):
+            if results[index] is None and key not in pending:
+                pending[key] = index
+        profile.count('simulations', len(pending))
+        cutoffs = [parent_cutoff(parents[index], fidelity) for index in pending.values()]
+        if evaluator is None:
+            # The batch is simulated back to back, sharing the setup of the instance.
+            with profile.timer('grade_many'):
+                graded = gl.grade_many([schedules[index] for index in pending.values()], streets, intersections,
+                                       paths, total_duration, bonus_points, yellow_phase,
+                                       duration_to_pass_through_a_traffic_light, engine=engine, cohorts=cohorts,
+                                       cutoffs=cutoffs, fidelity=fidelity)
+        else:
+            with profile.timer('grade_parallel'):
+                graded = evaluator.grade_many([schedules[index] for index in pending.values()],
+                                              [None if parents[index] is None else parents[index].scout
+                                               for index in pending.values()],
+                                              cutoffs, fidelity)
+        graded = dict(zip(pending, graded))
+        for key, result in graded.items():
+            if isinstance(result, gl.CutoffResult):
+                profile.count('aborted')
+            else:
+                fitness_cache.put(key, result)
+        return [graded[key] if result is None else result for key, result in zip(keys, results)]
+
+    def calibrate(schedules, results, screened=None):
+        # Every simulation result calibrates the surrogate, predictions made before it measure its accuracy.
+        if surrogate is None:
+            return
+        with profile.timer('surrogate'):
+            for index, (schedule, result) in enumerate(zip(schedules, results)):
+                if isinstance(result, gl.CutoffResult):
+                    continue
+                if screened is not None and screened[index] is not None:
+                    features, predicted = screened[index]
+                else:
+                    features, predicted = surrogate.schedule_features(schedule), None
+                surrogate.observe(features, result[0], predicted)
+
     patches = []
     ns = 20  # number of scout bees
     nb = 5  # number of best sites
@@ -310,87 +444,202 @@ def BeeHive(streets, intersections, paths, total_duration, bonus_points, termina
     shrinkageFactorReducedBy = 0.99  # by how much is the shrinkage factor reduceb by for iteration
     initialShrinkageFactor = shrinkageFactor
     countIterations = 0
+    evaluations = 0
+    started = time()
     executionTime = execution_time
-    print("Erdh qetu")
-    print(ns)
-    for i in range(0, ns):
-        print("Inside loop")
-        print(limit_on_minimum_cycle_length)
-        print(i)
-        if (use_seed == 'True' and i < 5):
-            sol = gl.readSolution(solution_file_path=solution_file_path, streets=streets)
-            if i != 0:
-                sol = shuffleOrder(sol, math.floor(len(intersections) * 0.2) + 1, intersections, name_to_i_street)
+    logger.debug("Number of scout bees: %d", ns)
+    signature = None
+    if checkpoint_path is not None or resume is not None:
+        signature = Checkpoint.instance_signature(streets, intersections, paths, total_duration, bonus_points,
+                                                  yellow_phase, duration_to_pass_through_a_traffic_light)
+    last_checkpoint = time()
+
+    def write_checkpoint():
+        with profile.timer('checkpoint'):
+            Checkpoint.save(checkpoint_path, signature, patches, shrinkageFactor, countIterations, evaluations,
+                            random.getstate())
+
+    try:
+        if resume is not None:
+            # Continue a checkpointed search where it stopped, only the time budget starts afresh.
+            checkpoint = Checkpoint.load(resume, signature)
+            for grade, sol, completed_cars, avg_cars, stagnation in checkpoint["patches"]:
+                patch = Patch(grade, sol, cars=completed_cars, avg=avg_cars)
+                patch.stgLim = stagnation
+                patches.append(patch)
+            shrinkageFactor = checkpoint["shrinkage_factor"]
+            countIterations = checkpoint["iterations"]
+            evaluations = checkpoint["evaluations"]
+            random.setstate(checkpoint["random_state"])
+            logger.info("Resumed %d patches after %d iterations from %s", len(patches), countIterations, resume)
         else:
-            sol = generateSolution(intersections, name_to_i_street, limit_on_minimum_green_phase_duration,
-                                   limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length, limit_on_maximum_cycle_length)
-        grade, completed_cars, avg_cars = gl.grade(sol, streets, intersections, paths, total_duration, bonus_points,
-                                                   yellow_phase, duration_to_pass_through_a_traffic_light)
-        patches.append(Patch(grade, sol, cars=completed_cars, avg=avg_cars))
-        print(i)
-    
-    print("PAra while")
-    print(limit_on_minimum_cycle_length)
-    while (time() - terminated_time < executionTime):
-        patches.sort(reverse=True, key=sortKey)
-        patches = patches[0: ns]
-        for i in range(0, nb):
-            employees = 0
-            if (i < ne):
-                employees = nre
-                patches[i].employees = nre
-            else:
-                employees = nrb
-                patches[i].employees = nrb
-            patches[i].stg = True
-            for e in range(0, employees):
-                print(limit_on_minimum_cycle_length)
-                tempSchedule = copyScheduleArray(patches[i].scout)
-                decideOperator = random.randint(0, 30)
-                if (decideOperator < 10):
-                    tempSchedule = shuffleOrder(tempSchedule, math.floor(len(intersections) * shrinkageFactor) + 1,
-                                                intersections, name_to_i_street)
-                elif (decideOperator >= 10 and decideOperator < 20):
-                    tempSchedule = swapOrder(tempSchedule, math.floor(len(intersections) * shrinkageFactor) + 1,
-                                             intersections, name_to_i_street)
+            solutions = []
+            for i in range(0, ns):
+                logger.debug("Initial scout %d", i)
+                if (use_seed == 'True' and i < 5):
+                    sol = gl.readSolution(solution_file_path=solution_file_path, streets=streets)
+                    if i != 0:
+                        sol = shuffleOrder(sol, math.floor(len(intersections) * 0.2) + 1, intersections,
+                                           name_to_i_street)
+                else:
+                    with profile.timer('generateSolution'):
+                        sol = generateSolution(intersections, name_to_i_street,
+                                               limit_on_minimum_green_phase_duration,
+                                               limit_on_maximum_green_phase_duration,
+                                               limit_on_minimum_cycle_length, limit_on_maximum_cycle_length)
+                # Patches keep their schedules packed, recruited bees copy them with two buffer copies.
+                solutions.append(gl.ScheduleArray.from_schedules(sol))
+            results = evaluate_batch(solutions)
+            calibrate(solutions, results)
+            for sol, (grade, completed_cars, avg_cars) in zip(solutions, results):
+                patches.append(Patch(grade, sol, cars=completed_cars, avg=avg_cars))
+
+        logger.debug("Initial patches graded, starting the search")
+        while (time() - terminated_time < executionTime):
+            with profile.timer('sort'):
+                patches.sort(reverse=True, key=sortKey)
+            patches = patches[0: ns]
+            # The recruited bees of all best sites are generated first and graded as one batch.
+            recruits = []
+            for i in range(0, nb):
+                employees = 0
+                if (i < ne):
+                    employees = nre
+                    patches[i].employees = nre
+                else:
+                    employees = nrb
+                    patches[i].employees = nrb
+                patches[i].stg = True
+                pool = employees * screening if surrogate is not None and surrogate.ready else employees
+                candidates = []
+                for e in range(0, pool):
+                    with profile.timer('copyScheduleArray'):
+                        tempSchedule = copyScheduleArray(patches[i].scout)
+                    decideOperator = random.randint(0, 30)
+                    if (decideOperator < 10):
+                        operator = 'shuffleOrder'
+                        with profile.timer(operator):
+                            tempSchedule = shuffleOrder(tempSchedule,
+                                                        math.floor(len(intersections) * shrinkageFactor) + 1,
+                                                        intersections, name_to_i_street)
+                    elif (decideOperator >= 10 and decideOperator < 20):
+                        operator = 'swapOrder'
+                        with profile.timer(operator):
+                            tempSchedule = swapOrder(tempSchedule, math.floor(len(intersections) * shrinkageFactor) + 1,
+                                                     intersections, name_to_i_street)
+                    else:
+                        operator = 'changeGreenTimeDuration'
+                        with profile.timer(operator):
+                            tempSchedule = changeGreenTimeDuration(tempSchedule,
+                                                                   math.floor(len(intersections) * shrinkageFactor * 0.001) + 1,
+                                                                   1, limit_on_minimum_green_phase_duration,
+                                                                   limit_on_maximum_green_phase_duration,
+                                                                   limit_on_minimum_cycle_length,
+                                                                   limit_on_maximum_cycle_length, i_id_to_intersection)
+                    profile.count(f'moves.{operator}')
+                    candidates.append((operator, tempSchedule))
+                if pool > employees:
+                    with profile.timer('surrogate'):
+                        screened = surrogate.screen([tempSchedule for _, tempSchedule in candidates], employees)
+                    for index, features, predicted in screened:
+                        operator, tempSchedule = candidates[index]
+                        recruits.append((i, operator, tempSchedule, (features, predicted)))
                 else:
-                    tempSchedule = changeGreenTimeDuration(tempSchedule,
-                                                           math.floor(len(intersections) * shrinkageFactor * 0.001) + 1,
-                                                           1, limit_on_minimum_green_phase_duration,
-                                                           limit_on_maximum_green_phase_duration,
-                                                           limit_on_minimum_cycle_length, limit_on_maximum_cycle_length,
-                                                           i_id_to_intersection)
-                tempScore, completed_cars1, avg_cars1 = gl.grade(tempSchedule, streets, intersections, paths,
-                                                                 total_duration, bonus_points, yellow_phase,
-                                                                 duration_to_pass_through_a_traffic_light)
+                    recruits.extend((i, operator, tempSchedule, None) for operator, tempSchedule in candidates)
+            screen_scores = [None] * len(recruits)
+            if not gl.is_full_fidelity(fidelity):
+                # Recruited bees are graded at the lower fidelity against their parents graded the same way,
+                # only the ones beating their parent there are graded again in full.
+                unscreened = [patch for patch in patches[0:nb] if patch.screen_score is None]
+                for patch, (screen_score, _, _) in zip(unscreened,
+                                                       evaluate_batch([patch.scout for patch in unscreened],
+                                                                      fidelity=fidelity)):
+                    patch.screen_score = screen_score
+                screen_results = evaluate_batch([tempSchedule for _, _, tempSchedule, _ in recruits],
+                                                [patches[i] for i, _, _, _ in recruits], fidelity)
+                promoted = [(recruit, screen_score)
+                            for recruit, (screen_score, _, _) in zip(recruits, screen_results)
+                            if screen_score > patches[recruit[0]].screen_score]
+                recruits = [recruit for recruit, _ in promoted]
+                screen_scores = [screen_score for _, screen_score in promoted]
+                profile.count('promotions', len(promoted))
+            results = evaluate_batch([tempSchedule for _, _, tempSchedule, _ in recruits],
+                                     [patches[i] for i, _, _, _ in recruits])
+            calibrate([tempSchedule for _, _, tempSchedule, _ in recruits], results,
+                      [prediction for _, _, _, prediction in recruits])
+            for (i, operator, tempSchedule, _), (tempScore, completed_cars1, avg_cars1), screen_score in zip(
+                    recruits, results, screen_scores):
                 if (tempScore > patches[i].score):
+                    profile.count(f'improvements.{operator}')
                     patches[i].stg = False
-                    patches.append(Patch(score=tempScore, scout=tempSchedule, cars=completed_cars1, avg=avg_cars1))
-            if (patches[i].stg):
-                patches[i].stgLim += 1
-            else:
-                patches[i].stgLim = 0
-            if (patches[i].stgLim > stgLim and i != 0):
-                solution = generateSolution(intersections, name_to_i_street, limit_on_minimum_green_phase_duration,
-                                            limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length, limit_on_maximum_cycle_length)
-                grade, completed_cars2, avg_cars2 = gl.grade(solution, streets, intersections, paths, total_duration,
-                                                             bonus_points, yellow_phase,
-                                                             duration_to_pass_through_a_traffic_light)
-                patches[i] = Patch(score=grade, scout=solution, cars=completed_cars2, avg=avg_cars2)
-        for i in range(nb, ns):
-            solution = generateSolution(intersections, name_to_i_street, limit_on_minimum_green_phase_duration,
-                                        limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length, limit_on_maximum_cycle_length)
-            grade, completed_cars4, avg_cars4 = gl.grade(solution, streets, intersections, paths, total_duration,
-                                                         bonus_points, yellow_phase,
-                                                         duration_to_pass_through_a_traffic_light)
-            patches.append(Patch(score=grade, scout=solution, cars=completed_cars4, avg=avg_cars4))
-        if (shrinkageFactor > 0.001):
-            shrinkageFactor *= shrinkageFactorReducedBy
-        countIterations += 1
-    patches.sort(reverse=True, key=sortKey)
+                    patch = Patch(score=tempScore, scout=tempSchedule, cars=completed_cars1, avg=avg_cars1)
+                    patch.screen_score = screen_score
+                    patches.append(patch)
+            # Stagnated best sites are abandoned and, like the remaining sites, replaced by new scouts.
+            scouts = []
+            for i in range(0, nb):
+                if (patches[i].stg):
+                    patches[i].stgLim += 1
+                else:
+                    patches[i].stgLim = 0
+                if (patches[i].stgLim > stgLim and i != 0):
+                    with profile.timer('generateSolution'):
+                        solution = generateSolution(intersections, name_to_i_street,
+                                                    limit_on_minimum_green_phase_duration,
+                                                    limit_on_maximum_green_phase_duration,
+                                                    limit_on_minimum_cycle_length, limit_on_maximum_cycle_length)
+                    scouts.append((i, solution))
+            for i in range(nb, ns):
+                with profile.timer('generateSolution'):
+                    solution = generateSolution(intersections, name_to_i_street, limit_on_minimum_green_phase_duration,
+                                                limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length,
+                                                limit_on_maximum_cycle_length)
+                scouts.append((None, solution))
+            scouts = [(i, gl.ScheduleArray.from_schedules(solution)) for i, solution in scouts]
+            results = evaluate_batch([solution for _, solution in scouts])
+            calibrate([solution for _, solution in scouts], results)
+            for (i, solution), (grade, completed_cars2, avg_cars2) in zip(scouts, results):
+                if i is None:
+                    patches.append(Patch(score=grade, scout=solution, cars=completed_cars2, avg=avg_cars2))
+                else:
+                    patches[i] = Patch(score=grade, scout=solution, cars=completed_cars2, avg=avg_cars2)
+            if (shrinkageFactor > 0.001):
+                shrinkageFactor *= shrinkageFactorReducedBy
+            countIterations += 1
+            if migrate is not None:
+                # Island model: exchange patches with other hives, immigrants compete in the next sort.
+                patches.extend(migrate(countIterations, patches))
+            if checkpoint_path is not None and time() - last_checkpoint >= checkpoint_interval:
+                write_checkpoint()
+                last_checkpoint = time()
+            if progress is not None:
+                # Report the best patch so far, the listener can end the search by returning True.
+                best = max(patches, key=sortKey)
+                elapsed = time() - started
+                if progress({"iteration": countIterations, "score": best.score, "cars": best.cars, "avg": best.avg,
+                             "evaluations": evaluations,
+                             "evaluations_per_second": evaluations / elapsed if elapsed > 0 else 0.0,
+                             "simulations": profile.counters.get('simulations', 0),
+                             "fitness_cache_hits": fitness_cache.hits,
+                             "fitness_cache_misses": fitness_cache.misses}):
+                    break
+        if checkpoint_path is not None:
+            write_checkpoint()
+    finally:
+        if evaluator is not None:
+            evaluator.shutdown()
+    with profile.timer('sort'):
+        patches.sort(reverse=True, key=sortKey)
+    profile.count('iterations', countIterations)
+    run_profile = profile.to_dict()
+    run_profile["fitness_cache"] = fitness_cache.stats()
+    if surrogate is not None:
+        run_profile["surrogate"] = surrogate.stats()
+    logger.info("Run profile: %s", run_profile)
     jsonFileInput = writeOutputToFile(patches, executionTime, countIterations, ns, nb, ne, nrb, nre, stgLim, initialShrinkageFactor,
-                      shrinkageFactorReducedBy, shrinkageFactor, time(), output_file_path, streets, intersections)
-    return patches[0].scout, patches[0].score, patches[0].cars, patches[0].avg, jsonFileInput
+                      shrinkageFactorReducedBy, shrinkageFactor, time(), output_file_path, streets, intersections,
+                      profile=run_profile)
+    return patches[0].scout.to_schedules(), patches[0].score, patches[0].cars, patches[0].avg, jsonFileInput
 
 
 # if __name__ == "__main__":
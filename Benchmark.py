@@ -0,0 +1,206 @@
+"""Offline performance benchmarks of the optimizer.
+
+Times reading an instance, grading a schedule with each requested engine,
+copying a schedule, every mutation operator, printing a solution as JSON and
+a BeeHive run with a fixed seed and a fixed number of iterations. Each
+benchmark reports the median and best time per call, calls per second and
+the peak memory allocated by one call (not traced for BeeHive, whose run is
+too long for ``tracemalloc``; the report ends with the peak RSS instead).
+
+Results can be saved as a JSON baseline and later runs compared against it;
+a benchmark whose median time grows by more than the tolerance is reported
+as a regression and the script exits with status 1.
+
+Example usage:
+    python Benchmark.py --input input/input.json --save-baseline benchmark_baseline.json
+    python Benchmark.py --input input/input.json --baseline benchmark_baseline.json
+
+Aliases:
+    -i, --input
+    -b, --baseline
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter, time
+
+import BeeHiveOptimization as bh
+import GlobalFunctions as gl
+from InstanceRegistry import instance_key
+
+
+def measure(func, setup=None, repeat=5, number=1, trace_memory=True):
+    """
+    Time ``func`` and return ``(median, best, peak_bytes)``, times in seconds per call.
+
+    ``setup`` (optional) builds the argument of every call outside the timed
+    region. The peak memory comes from one extra, untimed call under
+    ``tracemalloc``, it is None without ``trace_memory``.
+    """
+    times = []
+    for _ in range(repeat):
+        arguments = [setup() if setup else None for _ in range(number)]
+        start = perf_counter()
+        for argument in arguments:
+            func(argument)
+        times.append((perf_counter() - start) / number)
+    if not trace_memory:
+        return statistics.median(times), min(times), None
+
+    argument = setup() if setup else None
+    tracemalloc.start()
+    try:
+        func(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), min(times), peak
+
+
+def run_benchmarks(input_file_path, engines=('python',), repeat=5, beehive_iterations=3, seed=1):
+    """Run all benchmarks on ``input_file_path`` and return ``{name: result}``."""
+    results = {}
+
+    def record(name, median, best, peak, **extra):
+        results[name] = {"median": median, "best": best, "per_second": 1 / median if median > 0 else None,
+                         "peak_memory": peak, **extra}
+
+    record('readInput', *measure(lambda _: gl.readInput(input_file_path), repeat=repeat))
+
+    total_duration, bonus_points, intersections, streets, name_to_i_street, paths, \
+        duration_to_pass_through_a_traffic_light, yellow_phase, limit_on_minimum_cycle_length, \
+        limit_on_maximum_cycle_length, limit_on_minimum_green_phase_duration, \
+        limit_on_maximum_green_phase_duration, i_id_to_intersection = gl.readInput(input_file_path)
+
+    random.seed(seed)
+    schedule = gl.ScheduleArray.from_schedules(
+        bh.generateSolution(intersections, name_to_i_street, limit_on_minimum_green_phase_duration,
+                            limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length,
+                            limit_on_maximum_cycle_length))
+
+    for engine in engines:
+        record(f'grade[{engine}]', *measure(
+            lambda _: gl.grade(schedule, streets, intersections, paths, total_duration, bonus_points, yellow_phase,
+                               duration_to_pass_through_a_traffic_light, engine=engine),
+            repeat=repeat))
+
+    # The operators mutate their argument, every call gets a fresh copy built outside the timed region.
+    number = 200
+    record('copyScheduleArray', *measure(lambda _: bh.copyScheduleArray(schedule), repeat=repeat, number=number))
+    copy = lambda: bh.copyScheduleArray(schedule)
+    record('shuffleOrder', *measure(lambda s: bh.shuffleOrder(s, 1, intersections, name_to_i_street),
+                                    setup=copy, repeat=repeat, number=number))
+    record('swapOrder', *measure(lambda s: bh.swapOrder(s, 1, intersections, name_to_i_street),
+                                 setup=copy, repeat=repeat, number=number))
+    record('changeGreenTimeDuration', *measure(
+        lambda s: bh.changeGreenTimeDuration(s, 1, 1, limit_on_minimum_green_phase_duration,
+                                             limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length,
+                                             limit_on_maximum_cycle_length, i_id_to_intersection),
+        setup=copy, repeat=repeat, number=number))
+    record('print_json_solution', *measure(
+        lambda _: gl.print_json_solution(None, schedule, streets, intersections, None, None),
+        repeat=repeat, number=20))
+
+    # BeeHive stops through its progress callback, so the run does a fixed amount of work.
+    reports = []
+
+    def progress(report):
+        reports.append(report)
+        return report["iteration"] >= beehive_iterations
+
+    def beehive(_):
+        reports.clear()
+        random.seed(seed)
+        with tempfile.TemporaryDirectory() as directory:
+            return bh.BeeHive(streets, intersections, paths, total_duration, bonus_points, time(), yellow_phase,
+                              name_to_i_street, limit_on_minimum_green_phase_duration,
+                              limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length,
+                              limit_on_maximum_cycle_length, duration_to_pass_through_a_traffic_light,
+                              i_id_to_intersection, os.path.join(directory, 'output.json'),
+                              execution_time=float('inf'), cache_size=0, progress=progress)
+
+    median, best, peak = measure(beehive, repeat=1, trace_memory=False)
+    record(f'BeeHive[{beehive_iterations} iterations]', median, best, peak,
+           evaluations=reports[-1]["evaluations"], score=reports[-1]["score"],
+           evaluations_per_second=reports[-1]["evaluations"] / median)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return ``{name: relative change of the median}`` and the names slower than ``tolerance``."""
+    changes = {}
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None or not previous["median"]:
+            continue
+        changes[name] = result["median"] / previous["median"] - 1
+        if changes[name] > tolerance:
+            regressions.append(name)
+    return changes, regressions
+
+
+def print_results(results, changes):
+    print(f'{"benchmark":<34}{"median ms":>12}{"best ms":>12}{"calls/s":>12}{"peak KiB":>12}{"vs baseline":>14}')
+    for name, result in results.items():
+        change = f'{changes[name]:+.1%}' if name in changes else '-'
+        peak = '-' if result["peak_memory"] is None else f'{result["peak_memory"] / 1024:.1f}'
+        print(f'{name:<34}{result["median"] * 1000:>12.3f}{result["best"] * 1000:>12.3f}'
+              f'{result["per_second"] or 0:>12.1f}{peak:>12}{change:>14}')
+        if "evaluations_per_second" in result:
+            print(f'{"":<34}{result["evaluations"]} evaluations, '
+                  f'{result["evaluations_per_second"]:.1f} evaluations/s, score {result["score"]}')
+
+
+def main(input_file_path, engines, repeat, beehive_iterations, baseline_path, save_baseline_path, tolerance):
+    with open(input_file_path, 'rb') as f:
+        instance = instance_key(f.read())
+
+    results = run_benchmarks(input_file_path, engines, repeat, beehive_iterations)
+
+    changes, regressions = {}, []
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("instance") != instance:
+            print(f'Warning: the baseline was recorded on a different instance than {input_file_path}')
+        changes, regressions = compare(results, baseline["results"], tolerance)
+
+    print_results(results, changes)
+    # ru_maxrss is in KiB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'\nPeak RSS of the benchmark process: {max_rss / 1024:.1f} MiB')
+
+    if save_baseline_path is not None:
+        with open(save_baseline_path, 'w') as f:
+            json.dump({"instance": instance, "python": platform.python_version(), "machine": platform.machine(),
+                       "created": time(), "max_rss": max_rss, "results": results}, f, indent=2)
+        print(f'\nBaseline saved to {save_baseline_path}')
+
+    if regressions:
+        print(f'\nRegressions (median more than {tolerance:.0%} slower): {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='input/input.json')
+    parser.add_argument('--engines', type=str, default='python',
+                        help='comma separated grading engines to benchmark, e.g. python,event,numpy')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--beehive-iterations', type=int, default=3)
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', type=str, default=None, help='write the results as a baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown of the median reported as a regression')
+
+    args = parser.parse_args()
+    main(args.input, args.engines.split(','), args.repeat, args.beehive_iterations, args.baseline,
+         args.save_baseline, args.tolerance)
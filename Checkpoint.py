@@ -0,0 +1,163 @@
+"""Checkpoints of BeeHive runs.
+
+A long optimization dies with its process and takes its population along.
+``BeeHive(..., checkpoint_path=...)`` writes the state of the search to
+disk every ``checkpoint_interval`` seconds and when it ends: the patches
+(packed schedules with their score, cars, average waiting and stagnation
+counter), the shrinkage factor, the iteration and evaluation counts and the
+state of ``random``. ``BeeHive(..., resume=path)`` continues the search from
+such a file with a fresh time budget.
+
+The file is JSON, never a pickle, so reading one cannot run code. Every
+distinct ``ScheduleArray`` layout is stored once, usually one shared by all
+patches, and every patch refers to its layout and adds its ``orders`` and
+``green_times`` arrays, base64 encoded. A checkpoint is only accepted for
+the instance it was written for, see ``instance_signature``.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from array import array
+
+import GlobalFunctions as gl
+
+# Bump when the layout of the checkpoint changes, older checkpoints are then refused.
+CHECKPOINT_VERSION = 3
+
+
+def instance_signature(streets, intersections, paths, total_duration, bonus_points, yellow_phase,
+                       duration_to_pass_through_a_traffic_light):
+    """
+    Hash of everything of an instance that the scores of its schedules depend on.
+
+    That is the streets (ends, name and duration), the clearance intervals and signal groups of the
+    intersections, the paths of the cars and the parameters of the simulation, two instances with the same
+    signature grade every schedule alike.
+    """
+    digest = hashlib.sha256()
+    for street in streets:
+        digest.update(f'{street.id}:{street.start.id}:{street.end.id}:{street.duration}:{street.name}\n'.encode())
+    for intersection in intersections:
+        digest.update(f'{intersection.id}:{intersection.pedestrian_phase_interval}:'
+                      f'{intersection.all_red_phase_interval}:{sorted(intersection.signal_groups.items())}\n'
+                      .encode())
+    paths = gl.CarPaths.from_paths(streets, paths)
+    digest.update(_little_endian(paths.street_ids))
+    digest.update(_little_endian(paths.offsets))
+    digest.update(f'{total_duration}:{bonus_points}:{yellow_phase}:{duration_to_pass_through_a_traffic_light}'
+                  .encode())
+    return digest.hexdigest()
+
+
+def _little_endian(values):
+    # Signatures must not depend on the machine that computes them.
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _encode(values):
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+
+def _decode(text, byteorder):
+    values = array('i')
+    values.frombytes(base64.b64decode(text, validate=True))
+    if byteorder != sys.byteorder:
+        values.byteswap()
+    return values
+
+
+def save(path, signature, patches, shrinkage_factor, iterations, evaluations, random_state):
+    """
+    Write the state of a BeeHive search to ``path``.
+
+    ``patches`` is the population, objects with ``score``, ``scout`` (a ``gl.ScheduleArray``), ``cars``, ``avg``
+    and ``stgLim``, ``random_state`` is ``random.getstate()``. The file is replaced atomically, a crash while
+    writing leaves the previous checkpoint.
+    """
+    layouts = []
+    layout_index = {}
+    stored = []
+    for patch in patches:
+        scout = patch.scout
+        layout = {"i_intersections": _encode(scout.i_intersections), "offsets": _encode(scout.offsets),
+                  "slots": sorted(scout.slots.items())}
+        key = json.dumps(layout)
+        if key not in layout_index:
+            layout_index[key] = len(layouts)
+            layouts.append(layout)
+        stored.append({"score": patch.score, "cars": patch.cars, "avg": patch.avg, "stgLim": patch.stgLim,
+                       "layout": layout_index[key], "orders": _encode(scout.orders),
+                       "green_times": _encode(scout.green_times)})
+    version, internal_state, gauss_next = random_state
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "signature": signature,
+        "byteorder": sys.byteorder,
+        "layouts": layouts,
+        "patches": stored,
+        "shrinkage_factor": shrinkage_factor,
+        "iterations": iterations,
+        "evaluations": evaluations,
+        "random_state": [version, list(internal_state), gauss_next],
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(checkpoint, f, separators=(',', ':'))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def load(path, signature):
+    """
+    Read a checkpoint written by ``save`` for the instance with ``signature``.
+
+    Returns a dict with ``patches`` as ``(score, scout, cars, avg, stgLim)`` tuples, the scouts unpacked to
+    ``gl.ScheduleArray``, and ``shrinkage_factor``, ``iterations``, ``evaluations`` and ``random_state`` (for
+    ``random.setstate``). Raises ``ValueError`` for damaged checkpoints and those of another version or instance.
+    """
+    with open(path) as f:
+        try:
+            checkpoint = json.load(f)
+        except ValueError:
+            raise ValueError("The checkpoint is not valid JSON")
+    if not isinstance(checkpoint, dict) or checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"The checkpoint version is not supported, expected {CHECKPOINT_VERSION}")
+    if checkpoint.get("signature") != signature:
+        raise ValueError("The checkpoint was written for another instance")
+    try:
+        byteorder = checkpoint["byteorder"]
+        # Patches with the same layout share its arrays, as the copies of one ScheduleArray do.
+        layouts = [(_decode(layout["i_intersections"], byteorder), _decode(layout["offsets"], byteorder),
+                    {int(street_id): int(slot) for street_id, slot in layout["slots"]})
+                   for layout in checkpoint["layouts"]]
+        patches = []
+        for patch in checkpoint["patches"]:
+            i_intersections, offsets, slots = layouts[patch["layout"]]
+            orders = _decode(patch["orders"], byteorder)
+            green_times = _decode(patch["green_times"], byteorder)
+            if len(orders) != offsets[-1] or len(green_times) != len(slots):
+                raise ValueError("schedule arrays do not match the layout")
+            patches.append((patch["score"], gl.ScheduleArray(i_intersections, offsets, slots, orders, green_times),
+                            patch["cars"], patch["avg"], int(patch["stgLim"])))
+        version, internal_state, gauss_next = checkpoint["random_state"]
+        return {
+            "patches": patches,
+            "shrinkage_factor": float(checkpoint["shrinkage_factor"]),
+            "iterations": int(checkpoint["iterations"]),
+            "evaluations": int(checkpoint["evaluations"]),
+            "random_state": (version, tuple(internal_state), gauss_next),
+        }
+    except (KeyError, IndexError, TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"The checkpoint is damaged: {e}")
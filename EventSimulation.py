@@ -0,0 +1,229 @@
+"""Discrete-event simulation engine.
+
+Alternative backend to the tick loop in ``GlobalFunctions.grade``. Instead of
+visiting every second of ``total_duration`` the clock jumps between events
+kept in a priority queue:
+
+* street-arrival events, fired when a car reaches the end of a street, and
+* intersection wake-up events, fired on the seconds an intersection can
+  actually let a car through, i.e. while a phase is green and one of its
+  released streets has a queue, or at the next phase change that makes a
+  waiting street green.
+
+Within one second all intersection events run before the arrival events, the
+same order the tick loop uses, so the engine returns exactly the same
+``(score, completed_cars, avg_waiting)`` tuple. It is selected with
+``gl.grade(..., engine='event')``.
+"""
+import heapq
+from bisect import bisect_right
+from collections import deque
+
+import GlobalFunctions as gl
+
+WAKE = 0
+ARRIVAL = 1
+NEVER = float('inf')
+
+
+class EventNetwork:
+    """Street ids, durations and car paths of an instance as plain Python lists."""
+
+    def __init__(self, streets, intersections, paths):
+        self.streets = streets
+        self.intersections = intersections
+        self.paths = paths
+        self.durations = [street.duration for street in streets]
+        self.street_end = [street.end.id for street in streets]
+        car_paths = gl.CarPaths.from_paths(streets, paths)
+        # Global index of the first hop of every car, a hop being one street of a path.
+        self.hop_offsets = car_paths.offsets.tolist()
+        self.hop_street = car_paths.street_ids.tolist()
+        self.car_paths = [tuple(self.hop_street[start:end])
+                          for start, end in zip(self.hop_offsets, self.hop_offsets[1:])]
+        self.hop_car = [i_car for i_car, path in enumerate(self.car_paths) for _ in path]
+
+
+class SimulationTrace:
+    """Per-car trajectories and per-intersection statistics of one simulation.
+
+    Filled by ``grade_events(..., trace=SimulationTrace())``. Hops are indexed
+    globally (see ``EventNetwork.hop_offsets``); ``arrival_ticks[h]`` is the
+    second the car reached the end of the street of hop ``h`` (-1 for the
+    first street) and ``departure_ticks[h]`` the second it crossed the
+    intersection there, ``NEVER`` when that did not happen in the horizon.
+    """
+
+    def __init__(self):
+        self.network = None
+        self.total_duration = None
+        self.bonus_points = None
+        self.yellow_phase = None
+        self.duration_to_pass_through_a_traffic_light = None
+        self.phases_by_intersection = None
+        self.arrival_ticks = None
+        self.departure_ticks = None
+        self.street_hops = None
+        self.wake_ticks = None
+        self.wake_counts = None
+        self.wake_sums = None
+        self.result = None
+        # Per-street and prefix-sum views added by IncrementalEvaluation.trace_schedule.
+        self.street_arrivals = None
+        self.street_departures = None
+        self.wake_count_prefix = None
+        self.wake_sum_prefix = None
+
+_last_network = None
+
+
+def compile_network(streets, intersections, paths):
+    """Compile (or reuse the last compiled) network for the given instance."""
+    global _last_network
+    network = _last_network
+    if network is None or network.streets is not streets or network.paths is not paths \
+            or network.intersections is not intersections:
+        network = EventNetwork(streets, intersections, paths)
+        _last_network = network
+    return network
+
+
+def compile_phases(schedule, network, yellow_phase, duration_to_pass_through_a_traffic_light):
+    """Return the cached ``gl.PhaseTable`` of one intersection schedule, the engine uses its ``released`` phases."""
+    return gl.compile_phase_table(schedule, network.intersections[schedule.i_intersection], yellow_phase,
+                                  duration_to_pass_through_a_traffic_light)
+
+
+def _next_green(t, table, waiting_cars):
+    """First second >= ``t`` at which a green phase of ``table`` releases a waiting street, or None."""
+    cycle = table.cycle
+    starts = table.starts
+    phases = table.released
+    offset = t % cycle
+    i_phase = bisect_right(starts, offset) - 1
+    base = t - offset
+    for _ in range(len(starts) + 1):
+        released = phases[i_phase]
+        for street_id in released:
+            if waiting_cars[street_id]:
+                return max(t, base + starts[i_phase])
+        i_phase += 1
+        if i_phase == len(starts):
+            i_phase = 0
+            base += cycle
+    return None
+
+
+def grade_events(schedules, streets, intersections, paths, total_duration, bonus_points, yellow_phase,
+                 duration_to_pass_through_a_traffic_light, network=None, trace=None):
+    if network is None:
+        network = compile_network(streets, intersections, paths)
+    durations = network.durations
+    street_end = network.street_end
+    car_paths = network.car_paths
+
+    phases_by_intersection = {}
+    for schedule in schedules:
+        phases_by_intersection[schedule.i_intersection] = compile_phases(
+            schedule, network, yellow_phase, duration_to_pass_through_a_traffic_light)
+
+    waiting_cars = [deque() for _ in streets]
+    position = [0] * len(car_paths)
+    wake_time = {}
+    events = []
+    sequence = 0
+
+    def wake_up(i_intersection, t):
+        # Keep only the earliest pending wake-up per intersection, later ones go stale.
+        nonlocal sequence
+        t = _next_green(t, phases_by_intersection[i_intersection], waiting_cars)
+        if t is None or t >= total_duration:
+            return
+        pending = wake_time.get(i_intersection)
+        if pending is not None and pending <= t:
+            return
+        wake_time[i_intersection] = t
+        heapq.heappush(events, (t, WAKE, sequence, i_intersection))
+        sequence += 1
+
+    if trace is not None:
+        hop_offsets = network.hop_offsets
+        trace.network = network
+        trace.total_duration = total_duration
+        trace.bonus_points = bonus_points
+        trace.yellow_phase = yellow_phase
+        trace.duration_to_pass_through_a_traffic_light = duration_to_pass_through_a_traffic_light
+        trace.phases_by_intersection = phases_by_intersection
+        trace.arrival_ticks = [NEVER] * hop_offsets[-1]
+        trace.departure_ticks = [NEVER] * hop_offsets[-1]
+        trace.street_hops = [[] for _ in streets]
+        trace.wake_ticks = {i_intersection: [] for i_intersection in phases_by_intersection}
+        trace.wake_counts = {i_intersection: [] for i_intersection in phases_by_intersection}
+        trace.wake_sums = {i_intersection: [] for i_intersection in phases_by_intersection}
+
+    for i_car, path in enumerate(car_paths):
+        waiting_cars[path[0]].append(i_car)
+        if trace is not None:
+            trace.arrival_ticks[hop_offsets[i_car]] = -1
+            trace.street_hops[path[0]].append(hop_offsets[i_car])
+    for i_intersection in phases_by_intersection:
+        wake_up(i_intersection, 0)
+
+    num_cars_completed = 0
+    sum_waiting_cars = 0
+    waiting_cars_iteration = 0
+    score = 0
+
+    while events:
+        t, kind, _, payload = heapq.heappop(events)
+        if t >= total_duration:
+            break
+
+        if kind == WAKE:
+            if wake_time.get(payload) != t:
+                continue
+            del wake_time[payload]
+            table = phases_by_intersection[payload]
+            if trace is not None:
+                previous_iteration, previous_sum = waiting_cars_iteration, sum_waiting_cars
+            for street_id in table.released[bisect_right(table.starts, t % table.cycle) - 1]:
+                queue = waiting_cars[street_id]
+                if not queue:
+                    continue
+                waiting_cars_iteration += 1
+                sum_waiting_cars += len(queue)
+                car = queue.popleft()
+                if trace is not None:
+                    trace.departure_ticks[hop_offsets[car] + position[car]] = t
+                position[car] += 1
+                duration = durations[car_paths[car][position[car]]]
+                if duration < 1:
+                    raise ValueError
+                heapq.heappush(events, (t + duration - 1, ARRIVAL, sequence, car))
+                sequence += 1
+            if trace is not None and waiting_cars_iteration != previous_iteration:
+                trace.wake_ticks[payload].append(t)
+                trace.wake_counts[payload].append(waiting_cars_iteration - previous_iteration)
+                trace.wake_sums[payload].append(sum_waiting_cars - previous_sum)
+            wake_up(payload, t + 1)
+        else:
+            path = car_paths[payload]
+            street_id = path[position[payload]]
+            if trace is not None:
+                trace.arrival_ticks[hop_offsets[payload] + position[payload]] = t
+            if position[payload] == len(path) - 1:
+                # car finished its path
+                num_cars_completed += 1
+                score += bonus_points
+                score += total_duration - t - 1
+            else:
+                waiting_cars[street_id].append(payload)
+                if trace is not None:
+                    trace.street_hops[street_id].append(hop_offsets[payload] + position[payload])
+                i_intersection = street_end[street_id]
+                if i_intersection in phases_by_intersection:
+                    wake_up(i_intersection, t + 1)
+
+    if trace is not None:
+        trace.result = (score, num_cars_completed, sum_waiting_cars, waiting_cars_iteration)
+    return score, num_cars_completed, sum_waiting_cars / waiting_cars_iteration
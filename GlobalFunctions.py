@@ -1,20 +1,22 @@
 import json
-from collections import deque
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping, Sequence
+from itertools import islice
 import os
+import threading
 
 from flask import jsonify
 from recordclass import recordclass
 
+from JsonStream import iter_object
+
 Street = recordclass('Street', [
     'id',
     'start',
     'end',
     'name',
-    'duration',
-    'driving_cars',
-    'waiting_cars',
-    'arrival_times',
-    'departure_times'
+    'duration'
 ])
 
 Intersection = recordclass('Intersection', [
@@ -22,22 +24,406 @@ Intersection = recordclass('Intersection', [
     'name',
     'incomings',
     'outgoings',
-    'green_street',
-    'num_waiting_cars',
-    'schedule_duration',
     'using_streets',
     'streets_usage',
-    'green_street_per_t_mod',
-    'needs_updates',
     'pedestrian_phase_interval',
     'all_red_phase_interval',
-    'constraints'
+    'constraints',
+    'signal_groups',
+    'phase_order'
 ])
 Schedule = recordclass('Schedule', [
     'i_intersection',
     'order',
     'green_times'
 ])
+CarCohorts = recordclass('CarCohorts', [
+    'queues',
+    'counts',
+    'num_cohorts'
+])
+Fidelity = recordclass('Fidelity', [
+    'horizon',
+    'sample'
+])
+PhaseTable = recordclass('PhaseTable', [
+    'cycle',
+    'starts',
+    'street_ids',
+    'released',
+    'green'
+])
+
+# Grading levels of ``grade``: the share of the horizon simulated and the share of the cars sampled.
+FIDELITY_LEVELS = {
+    'full': Fidelity(horizon=1.0, sample=1.0),
+    'medium': Fidelity(horizon=1.0, sample=0.5),
+    'low': Fidelity(horizon=0.5, sample=0.25),
+}
+
+
+def fidelity_level(fidelity):
+    """Return the ``Fidelity`` of ``fidelity``, a name of ``FIDELITY_LEVELS`` or a ``Fidelity``."""
+    if isinstance(fidelity, str):
+        if fidelity not in FIDELITY_LEVELS:
+            raise ValueError(f"Unknown fidelity {fidelity!r}, expected one of {list(FIDELITY_LEVELS)}")
+        return FIDELITY_LEVELS[fidelity]
+    return fidelity
+
+
+def is_full_fidelity(fidelity):
+    """Whether ``fidelity`` simulates the whole horizon with every car, i.e. grades exactly."""
+    level = fidelity_level(fidelity)
+    return level.horizon >= 1 and level.sample >= 1
+
+
+class ScheduleArray:
+    """
+    Array-backed list of intersection schedules.
+
+    The phase orders of all intersections are stored back to back in one flat
+    ``orders`` array, intersection ``k`` owning ``orders[offsets[k]:offsets[k + 1]]``,
+    and the green times in one flat ``green_times`` array, street ``s`` at
+    ``green_times[slots[s]]``. The layout (``i_intersections``, ``offsets``,
+    ``slots``) never changes and is shared by all copies, so ``copy`` is two
+    buffer copies.
+
+    Indexing returns a ``ScheduleView`` that reads and writes through to the
+    arrays, so code written for a list of ``Schedule`` works unchanged.
+    """
+
+    __slots__ = ('i_intersections', 'offsets', 'slots', 'orders', 'green_times')
+
+    def __init__(self, i_intersections, offsets, slots, orders, green_times):
+        self.i_intersections = i_intersections
+        self.offsets = offsets
+        self.slots = slots
+        self.orders = orders
+        self.green_times = green_times
+
+    @classmethod
+    def from_schedules(cls, schedules):
+        """Pack a list of ``Schedule`` (or another ``ScheduleArray``), ordered by intersection id."""
+        if isinstance(schedules, ScheduleArray):
+            return schedules.copy()
+        i_intersections = array('i')
+        offsets = array('i', [0])
+        slots = {}
+        orders = array('i')
+        green_times = array('i')
+        for schedule in sorted(schedules, key=lambda schedule: schedule.i_intersection):
+            i_intersections.append(schedule.i_intersection)
+            # slots sorted by street id keep the arrays canonical, see fingerprint
+            for street_id in sorted(schedule.green_times):
+                slots[street_id] = len(green_times)
+                green_times.append(schedule.green_times[street_id])
+            orders.extend(schedule.order)
+            offsets.append(len(orders))
+        return cls(i_intersections, offsets, slots, orders, green_times)
+
+    def to_schedules(self):
+        return [Schedule(i_intersection=schedule.i_intersection,
+                         order=list(schedule.order),
+                         green_times=dict(schedule.green_times))
+                for schedule in self]
+
+    def copy(self):
+        return ScheduleArray(self.i_intersections, self.offsets, self.slots, self.orders[:], self.green_times[:])
+
+    def fingerprint(self):
+        """Same value for equal schedules packed with ``from_schedules``, see ``schedule_fingerprint``."""
+        return self.i_intersections.tobytes(), self.orders.tobytes(), self.green_times.tobytes()
+
+    def __len__(self):
+        return len(self.i_intersections)
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += len(self.i_intersections)
+        if not 0 <= k < len(self.i_intersections):
+            raise IndexError('schedule index out of range')
+        return ScheduleView(self, k)
+
+    def __setitem__(self, k, schedule):
+        view = self[k]
+        if isinstance(schedule, ScheduleView) and schedule.solution is self and schedule.k == view.k:
+            return
+        if schedule.i_intersection != view.i_intersection:
+            raise ValueError('schedule is for a different intersection')
+        for street_id, green_time in schedule.green_times.items():
+            view.green_times[street_id] = green_time
+        view.order = schedule.order
+
+    def __iter__(self):
+        for k in range(len(self.i_intersections)):
+            yield ScheduleView(self, k)
+
+
+class ScheduleView:
+    """Schedule of the ``k``-th intersection of a ``ScheduleArray``."""
+
+    __slots__ = ('solution', 'k')
+
+    def __init__(self, solution, k):
+        self.solution = solution
+        self.k = k
+
+    @property
+    def i_intersection(self):
+        return self.solution.i_intersections[self.k]
+
+    @property
+    def order(self):
+        return OrderView(self.solution, self.solution.offsets[self.k], self.solution.offsets[self.k + 1])
+
+    @order.setter
+    def order(self, order):
+        start, end = self.solution.offsets[self.k], self.solution.offsets[self.k + 1]
+        if len(order) != end - start:
+            raise ValueError('a phase order cannot change its number of streets')
+        self.solution.orders[start:end] = array('i', order)
+
+    @property
+    def green_times(self):
+        return GreenTimesView(self.solution, self.solution.offsets[self.k], self.solution.offsets[self.k + 1])
+
+
+class OrderView(Sequence):
+    """Write-through phase order of one intersection of a ``ScheduleArray``."""
+
+    __slots__ = ('orders', 'start', 'end')
+
+    def __init__(self, solution, start, end):
+        self.orders = solution.orders
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.orders[self.start:self.end][i].tolist()
+        if i < 0:
+            i += self.end - self.start
+        if not 0 <= i < self.end - self.start:
+            raise IndexError('order index out of range')
+        return self.orders[self.start + i]
+
+    def __setitem__(self, i, street_id):
+        if i < 0:
+            i += self.end - self.start
+        if not 0 <= i < self.end - self.start:
+            raise IndexError('order index out of range')
+        self.orders[self.start + i] = street_id
+
+    def __iter__(self):
+        return iter(self.orders[self.start:self.end])
+
+
+class GreenTimesView(MutableMapping):
+    """Write-through ``street id -> green time`` mapping of one intersection of a ``ScheduleArray``."""
+
+    __slots__ = ('solution', 'start', 'end')
+
+    def __init__(self, solution, start, end):
+        self.solution = solution
+        self.start = start
+        self.end = end
+
+    def _slot(self, street_id):
+        # an intersection's green time slots cover the same range as its phase order
+        slot = self.solution.slots.get(street_id, -1)
+        if not self.start <= slot < self.end:
+            raise KeyError(street_id)
+        return slot
+
+    def __getitem__(self, street_id):
+        return self.solution.green_times[self._slot(street_id)]
+
+    def __setitem__(self, street_id, green_time):
+        self.solution.green_times[self._slot(street_id)] = green_time
+
+    def __delitem__(self, street_id):
+        raise TypeError('streets cannot be removed from a ScheduleArray')
+
+    def __contains__(self, street_id):
+        return self.start <= self.solution.slots.get(street_id, -1) < self.end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return iter(self.solution.orders[self.start:self.end])
+
+
+class CarPaths(Sequence):
+    """
+    Paths of all cars in compressed-sparse-row form.
+
+    Car ``i`` drives the streets ``street_ids[offsets[i]:offsets[i + 1]]`` in
+    order. The simulations walk these arrays with one cursor per car and never
+    copy or modify them. Indexing returns a ``PathView`` of ``Street`` objects
+    for code that looks at single paths.
+    """
+
+    __slots__ = ('streets', 'street_ids', 'offsets', '_cohorts', '_remaining_times', '_samples', '_setup')
+
+    def __init__(self, streets, street_ids=None, offsets=None):
+        self.streets = streets
+        self.street_ids = array('i') if street_ids is None else street_ids
+        self.offsets = array('q', [0]) if offsets is None else offsets
+        self._cohorts = None
+        self._remaining_times = None
+        self._samples = None
+        self._setup = None
+
+    @classmethod
+    def from_paths(cls, streets, paths):
+        """Pack a list of paths of ``Street`` objects, ``CarPaths`` are returned as they are."""
+        if isinstance(paths, CarPaths):
+            return paths
+        car_paths = cls(streets)
+        for path in paths:
+            car_paths.append(street.id for street in path)
+        return car_paths
+
+    def append(self, street_ids):
+        self.street_ids.extend(street_ids)
+        self.offsets.append(len(self.street_ids))
+        self._cohorts = None
+        self._remaining_times = None
+        self._samples = None
+        self._setup = None
+
+    def cohorts(self):
+        """
+        The initial queues grouped into cohorts, computed on first use.
+
+        ``queues[s]`` lists the cohorts of the cars that start on street ``s``
+        in queue order and ``counts[s]`` their number of cars. A cohort is a
+        run of consecutive cars of a queue with the same path, as a ``range``
+        or tuple of car ids; its cars leave the queue in that order.
+        """
+        if self._cohorts is None:
+            street_ids = self.street_ids
+            offsets = self.offsets
+            queues = [[] for _ in self.streets]
+            routes = [None] * len(self.streets)
+            for car in range(len(offsets) - 1):
+                route = street_ids[offsets[car]:offsets[car + 1]]
+                queue = queues[route[0]]
+                if routes[route[0]] == route:
+                    queue[-1].append(car)
+                else:
+                    routes[route[0]] = route
+                    queue.append([car])
+            num_cohorts = 0
+            for queue in queues:
+                for i, cars in enumerate(queue):
+                    contiguous = cars[-1] - cars[0] == len(cars) - 1
+                    queue[i] = range(cars[0], cars[-1] + 1) if contiguous else tuple(cars)
+                num_cohorts += len(queue)
+            self._cohorts = CarCohorts(queues=queues, counts=[sum(map(len, queue)) for queue in queues],
+                                       num_cohorts=num_cohorts)
+        return self._cohorts
+
+    def grade_setup(self):
+        """The ``GradeSetup`` of per-car grading for these paths, computed on first use."""
+        if self._setup is None:
+            self._setup = GradeSetup(self.streets, self)
+        return self._setup
+
+    def remaining_times(self):
+        """
+        Free-flow driving time from every hop to the end of its path, computed on first use.
+
+        ``remaining_times()[h]`` sums the durations of ``street_ids[h:offsets[i + 1]]`` for the car ``i``
+        that hop ``h`` belongs to.
+        """
+        if self._remaining_times is None:
+            durations = [street.duration for street in self.streets]
+            street_ids = self.street_ids
+            offsets = self.offsets
+            remaining = array('q', bytes(8 * len(street_ids)))
+            for car in range(len(offsets) - 1):
+                total = 0
+                for hop in range(offsets[car + 1] - 1, offsets[car] - 1, -1):
+                    total += durations[street_ids[hop]]
+                    remaining[hop] = total
+            self._remaining_times = remaining
+        return self._remaining_times
+
+    def sample(self, fraction):
+        """
+        Stratified sample of about ``fraction`` of the cars as a new ``CarPaths``, computed on first use.
+
+        The cars with the same path form a stratum and every stratum keeps its
+        share of the cars, up to rounding: the strata are laid out one after
+        the other and every ``1 / fraction``-th car is taken. The sampled cars
+        keep their order, so they queue as in the full instance.
+        """
+        if self._samples is None:
+            self._samples = {}
+        sample = self._samples.get(fraction)
+        if sample is None:
+            street_ids = self.street_ids
+            offsets = self.offsets
+            strata = {}
+            for car in range(len(offsets) - 1):
+                strata.setdefault(street_ids[offsets[car]:offsets[car + 1]].tobytes(), []).append(car)
+            cars = []
+            position = 0
+            for stratum in strata.values():
+                for car in stratum:
+                    if int((position + 1) * fraction) > int(position * fraction):
+                        cars.append(car)
+                    position += 1
+            if not cars and len(self):
+                cars.append(0)
+            sample = CarPaths(self.streets)
+            for car in sorted(cars):
+                sample.append(street_ids[offsets[car]:offsets[car + 1]])
+            self._samples[fraction] = sample
+        return sample
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.offsets) - 1
+        if not 0 <= i < len(self.offsets) - 1:
+            raise IndexError('car index out of range')
+        return PathView(self, self.offsets[i], self.offsets[i + 1])
+
+
+class PathView(Sequence):
+    """Read-only path of one car of a ``CarPaths``, as ``Street`` objects."""
+
+    __slots__ = ('car_paths', 'start', 'end')
+
+    def __init__(self, car_paths, start, end):
+        self.car_paths = car_paths
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.car_paths.streets[street_id]
+                    for street_id in self.car_paths.street_ids[self.start:self.end][k]]
+        if k < 0:
+            k += self.end - self.start
+        if not 0 <= k < self.end - self.start:
+            raise IndexError('path index out of range')
+        return self.car_paths.streets[self.car_paths.street_ids[self.start + k]]
+
+    def __iter__(self):
+        streets = self.car_paths.streets
+        return (streets[street_id] for street_id in self.car_paths.street_ids[self.start:self.end])
 
 
 def readSolution(solution_file_path, streets):
@@ -46,6 +432,10 @@ def readSolution(solution_file_path, streets):
 
     num_intersections = int(lines.popleft())
 
+    street_ids = {}
+    for street in streets:
+        street_ids.setdefault(street.name, street.id)
+
     schedules = []
     for i in range(0, num_intersections):
         i_intersection = int(lines.popleft())
@@ -56,11 +446,7 @@ def readSolution(solution_file_path, streets):
             street_name, green_time_str = lines.popleft().split()
             green_time = int(green_time_str)
 
-            street_id = None
-            for street in streets:
-                if street.name == street_name:
-                    street_id = street.id
-                    break
+            street_id = street_ids.get(street_name)
 
             order.append(street_id)
             green_times[street_id] = green_time
@@ -76,13 +462,25 @@ def readInput(input_file_path):
     # filename = "Instances/" + input_file_path
     filename = os.path.abspath(input_file_path)
 
+    # The cars array is streamed, every path goes straight into the packed CarPaths.
+    json_file = {}
+    network = None
     with open(filename, 'r') as f:
-        json_file = json.load(f)
+        for key, value in iter_object(f, stream_keys=('cars',)):
+            if key != 'cars':
+                json_file[key] = value
+            elif 'simulation' in json_file and 'intersections' in json_file and 'streets' in json_file:
+                network = _readNetwork(json_file)
+                paths = _readPaths(network, islice(value, json_file['simulation']['cars']))
+            else:
+                # cars listed before the network, keep them until the streets are known
+                json_file['cars'] = list(value)
+    if network is None:
+        network = _readNetwork(json_file)
+        paths = _readPaths(network, islice(json_file.get('cars', ()), json_file['simulation']['cars']))
+    intersections, i_id_to_intersection, streets, name_to_street = network
 
     total_duration = json_file['simulation']['duration']
-    num_intersections = json_file['simulation']['intersections']
-    num_streets = json_file['simulation']['streets']
-    num_cars = json_file['simulation']['cars']
     bonus_points = json_file['simulation']['bonus']
     duration_to_pass_through_a_traffic_light = json_file['simulation']['duration_to_pass_through_a_traffic_light']
     yellow_phase = json_file['simulation']['yellow_phase']
@@ -90,20 +488,66 @@ def readInput(input_file_path):
     limit_on_maximum_cycle_length = json_file['simulation']['limit_on_maximum_cycle_length']
     limit_on_minimum_green_phase_duration = json_file['simulation']['limit_on_minimum_green_phase_duration']
     limit_on_maximum_green_phase_duration = json_file['simulation']['limit_on_maximum_green_phase_duration']
+
+    intersection_ids = {}
+    for x in intersections:
+        intersection_ids.setdefault(x.name, x.id)
+    for constraint in json_file['constraints']:
+        # if (constraint['intersection_name'] == 'BillClinton'):
+        #     print("C: ", constraint)
+        x_id = intersection_ids.get(constraint['intersection_name'], -1)
+        if (x_id == -1):
+            continue
+        intersection = intersections[x_id]
+        if (constraint['type'] == 'simultaneously_signal'):
+            if ('simultaneously_signal' in intersection.constraints):
+                intersection.constraints['simultaneously_signal'].append(constraint['streets'])
+            else:
+                intersection.constraints['simultaneously_signal'] = [constraint['streets']]
+        elif (constraint['type'] == 'signal_phase_order'):
+            intersection.constraints['signal_phase_order'] = constraint['streets']
+
+        # if (constraint['intersection_name'] == 'BillClinton'):
+        #     print("I: ", intersection.constraints)
+
+    def street_ids(names, intersection):
+        for name in names:
+            if name not in name_to_street:
+                raise ValueError(f"Unknown street {name!r} in a constraint of intersection {intersection.name!r}")
+        return [name_to_street[name].id for name in names]
+
+    # Compile the constraints to street ids once, so the simulation and the operators never look up names.
+    for intersection in intersections:
+        for group in intersection.constraints.get('simultaneously_signal', []):
+            group_ids = street_ids(group, intersection)
+            for street_id in group_ids:
+                # a green street releases the first group it belongs to, itself first
+                if street_id not in intersection.signal_groups:
+                    intersection.signal_groups[street_id] = (street_id,) + tuple(
+                        other for other in group_ids if other != street_id)
+        intersection.phase_order = street_ids(intersection.constraints.get('signal_phase_order', []), intersection)
+
+    for inter in intersections:
+        # streets used by cars, in order of first use
+        intersections[inter.id].using_streets = list(intersections[inter.id].streets_usage)
+    return total_duration, bonus_points, intersections, \
+        streets, name_to_street, paths, duration_to_pass_through_a_traffic_light, \
+        yellow_phase, limit_on_minimum_cycle_length, limit_on_maximum_cycle_length, \
+        limit_on_minimum_green_phase_duration, limit_on_maximum_green_phase_duration, i_id_to_intersection
+
+
+def _readNetwork(json_file):
     intersections = tuple(Intersection(id=inter['id'],
                                        name=inter['name'],
                                        incomings=deque(),
                                        outgoings=deque(),
-                                       green_street=None,
-                                       num_waiting_cars=None,
-                                       green_street_per_t_mod=[],
-                                       schedule_duration=None,
                                        using_streets=deque(),
                                        streets_usage=dict(),
-                                       needs_updates=False,
                                        pedestrian_phase_interval=inter['pedestrian_phase_interval'],
                                        all_red_phase_interval=inter['all_red_phase_interval'],
-                                       constraints={})
+                                       constraints={},
+                                       signal_groups={},
+                                       phase_order=[])
                           for inter in json_file['intersections'])
 
     i_id_to_intersection = {}
@@ -126,114 +570,345 @@ def readInput(input_file_path):
                         start=intersections[start],
                         end=intersections[end],
                         name=name,
-                        duration=duration,
-                        driving_cars={},
-                        waiting_cars=deque(),
-                        arrival_times={},
-                        departure_times={})
+                        duration=duration)
         name_to_street[name] = street
         intersections[start].outgoings.append(street)
         intersections[end].incomings.append(street)
         streets.append(street)
+    return intersections, i_id_to_intersection, streets, name_to_street
 
-    # Parse the paths
-    paths = []
-    for i_car in range(num_cars):
-        path_length = json_file['cars'][i_car]['path_length']
-        path = json_file['cars'][i_car]['path']
+
+def _readPaths(network, cars):
+    intersections, _, streets, name_to_street = network
+    paths = CarPaths(streets)
+    for i_car, car in enumerate(cars):
+        path_length = car['path_length']
+        # A car is created at the end of its first street and leaves at the end of its last one, every engine
+        # relies on the two being different streets.
+        if path_length < 2:
+            raise ValueError(f"Car {i_car} has a path of {path_length} street(s), at least 2 are needed")
+        path = [name_to_street[name] for name in car['path']]
 
         assert len(path) == path_length
-        for name in path:
-            id_inter = name_to_street[name].end.id
-            intersections[id_inter].using_streets.append(name)
-            if name in intersections[id_inter].streets_usage:
-                intersections[id_inter].streets_usage[name] += 1
-            else:
-                intersections[id_inter].streets_usage[name] = 1
+        for street in path:
+            streets_usage = intersections[street.end.id].streets_usage
+            streets_usage[street.name] = streets_usage.get(street.name, 0) + 1
 
-        path = deque(name_to_street[name] for name in path)
-        paths.append(path)
+        paths.append(street.id for street in path)
+    return paths
 
-    for constraint in json_file['constraints']:
-        # if (constraint['intersection_name'] == 'BillClinton'):
-        #     print("C: ", constraint)
-        x_id = -1
-        for x in intersections:
-            if x.name == constraint['intersection_name']:
-                x_id = x.id
-                break
-        if (x_id == -1):
+
+class SimulationState:
+    """
+    Run-time state of one ``grade`` call.
+
+    Everything the simulation mutates lives here, indexed by street,
+    intersection and car id, so the Street and Intersection objects built by
+    ``readInput`` (and the car paths) only describe the network and are never
+    written to. Each call gets its own state, which makes ``grade``
+    re-entrant and safe to run from several threads at once.
+    """
+
+    def __init__(self, streets, intersections, paths):
+        self.driving_cars = [{} for _ in streets]
+        self.waiting_cars = [deque() for _ in streets]
+        # id of the green street of every intersection, -1 while no traffic can pass
+        self.green_street = [-1] * len(intersections)
+        self.num_waiting_cars = [0] * len(intersections)
+        # compiled cycle of every scheduled intersection, see ``compile_phase_table``
+        self.phase_tables = [None] * len(intersections)
+        self.needs_updates = [False] * len(intersections)
+        # Cursor of every car into ``CarPaths.street_ids``, the index of its next street.
+        self.path_positions = [0] * len(paths)
+        # Cohort mode: cars still in the initial queue of every street, and the next of them to leave.
+        self.initial_waiting = [0] * len(streets)
+        self.cohort_index = [0] * len(streets)
+        self.cohort_taken = [0] * len(streets)
+
+
+class GradeSetup:
+    """
+    The part of ``grade`` that only depends on the instance and the paths.
+
+    Holds the packed paths, the initial queue of every street and the first
+    path cursor of every car. Only per-car grading needs it, cohort mode
+    seeds the queues from ``CarPaths.cohorts``. ``CarPaths.grade_setup``
+    builds it once per paths, so every grade of the same instance shares it.
+    """
+
+    def __init__(self, streets, paths):
+        self.streets = streets
+        self.paths = paths = CarPaths.from_paths(streets, paths)
+        street_ids = paths.street_ids
+        offsets = paths.offsets
+        # (street id, cars starting there in queue order), streets in the order their first car appears
+        queues = {}
+        for i_car in range(len(paths)):
+            queues.setdefault(street_ids[offsets[i_car]], []).append(i_car)
+        self.initial_queues = list(queues.items())
+        self.first_positions = [offsets[i_car] + 1 for i_car in range(len(paths))]
+
+
+PHASE_TABLE_CACHE_SIZE = 20000
+_phase_tables = OrderedDict()
+_phase_tables_lock = threading.Lock()
+
+
+def compile_phase_table(schedule, intersection, yellow_phase, duration_to_pass_through_a_traffic_light):
+    """
+    Compile the cycle of an intersection schedule into a ``PhaseTable``.
+
+    Phase ``k`` starts ``starts[k]`` seconds into the cycle and lets the
+    street ``street_ids[k]`` drive, -1 while no traffic can pass (yellow
+    loss, pedestrian and all-red seconds). ``released[k]`` holds the streets
+    that drive with it, its ``simultaneously_signal`` group with the green
+    street first (empty for -1). ``green`` holds the green street per
+    second, ``green[t % cycle]`` is the green street at time ``t``. A single
+    street schedule never switches, its table is one green second.
+
+    Tables only depend on the phase order, the green times, the signal
+    groups and the timing parameters, they are cached so that the
+    intersections a candidate did not change reuse the tables of its parent,
+    in every engine.
+    """
+    order = tuple(schedule.order)
+    green_times = tuple(schedule.green_times[street_id] for street_id in order)
+    signal_groups = tuple(intersection.signal_groups.get(street_id, (street_id,)) for street_id in order)
+    key = (order, green_times, signal_groups, intersection.pedestrian_phase_interval,
+           intersection.all_red_phase_interval, yellow_phase, duration_to_pass_through_a_traffic_light)
+    with _phase_tables_lock:
+        table = _phase_tables.get(key)
+        if table is not None:
+            _phase_tables.move_to_end(key)
+            return table
+
+    if len(order) == 1:
+        # single street schedules never switch, the first street stays green
+        table = PhaseTable(cycle=1, starts=array('i', [0]), street_ids=array('i', order), released=signal_groups,
+                           green=array('i', order))
+        return _cache_phase_table(key, table)
+
+    # Consider the usage factor of green time (set to 0.7 based on measurements)
+    usage_factor = 1 / duration_to_pass_through_a_traffic_light
+    starts = array('i')
+    street_ids = array('i')
+    # The phases are laid out back to back from ``position`` 0, the cycle advances by the green times. When the
+    # yellow phase is longer than a green time the layout runs ahead of the cycle, its tail is never green.
+    position = 0
+    cycle = 0
+    for street_id, green_time in zip(order, green_times):
+        # Only the green time without the yellow phase, times the usage factor, lets traffic pass.
+        green_time_usage = int(usage_factor * (green_time - yellow_phase))
+        if green_time_usage > 0:
+            starts.append(position)
+            street_ids.append(street_id)
+            position += green_time_usage
+        if green_time - green_time_usage > 0:
+            starts.append(position)
+            street_ids.append(-1)
+            position += green_time - green_time_usage
+        cycle += green_time
+    # pedestrian and all-red seconds close the cycle
+    clearance_interval = intersection.pedestrian_phase_interval + intersection.all_red_phase_interval
+    if clearance_interval > 0:
+        starts.append(position)
+        street_ids.append(-1)
+        position += clearance_interval
+    cycle += clearance_interval
+
+    green = array('i', bytes(4 * cycle))
+    for k, start in enumerate(starts):
+        end = starts[k + 1] if k + 1 < len(starts) else position
+        for offset in range(start, min(end, cycle)):
+            green[offset] = street_ids[k]
+    # The phases within the cycle, adjacent phases without traffic merged.
+    groups = dict(zip(order, signal_groups))
+    phase_starts = array('i')
+    phase_street_ids = array('i')
+    released = []
+    for start, street_id in zip(starts, street_ids):
+        if start >= cycle:
+            break
+        if phase_street_ids and phase_street_ids[-1] == street_id:
             continue
-        intersection = intersections[x_id]
-        if (constraint['type'] == 'simultaneously_signal'):
-            if ('simultaneously_signal' in intersection.constraints):
-                intersection.constraints['simultaneously_signal'].append(constraint['streets'])
-            else:
-                intersection.constraints['simultaneously_signal'] = [constraint['streets']]
-        elif (constraint['type'] == 'signal_phase_order'):
-            intersection.constraints['signal_phase_order'] = constraint['streets']
+        phase_starts.append(start)
+        phase_street_ids.append(street_id)
+        released.append(groups[street_id] if street_id >= 0 else ())
+    table = PhaseTable(cycle=cycle, starts=phase_starts, street_ids=phase_street_ids, released=tuple(released),
+                       green=green)
+    return _cache_phase_table(key, table)
 
-        # if (constraint['intersection_name'] == 'BillClinton'):
-        #     print("I: ", intersection.constraints)
 
-    for inter in intersections:
-        # delete duplicates in using_streets array
-        intersections[inter.id].using_streets = list(dict.fromkeys(intersections[inter.id].using_streets))
-    return total_duration, bonus_points, intersections, \
-        streets, name_to_street, paths, duration_to_pass_through_a_traffic_light, \
-        yellow_phase, limit_on_minimum_cycle_length, limit_on_maximum_cycle_length, \
-        limit_on_minimum_green_phase_duration, limit_on_maximum_green_phase_duration, i_id_to_intersection
+def _cache_phase_table(key, table):
+    # A table compiled meanwhile by another thread wins, so that equal schedules share one table.
+    with _phase_tables_lock:
+        table = _phase_tables.setdefault(key, table)
+        if len(_phase_tables) > PHASE_TABLE_CACHE_SIZE:
+            _phase_tables.popitem(last=False)
+    return table
 
 
-def get_artificial_street():
+class GradeTrace:
+    """
+    Columnar record of one ``grade`` simulation, for analysis and export.
+
+    Filled by ``grade(..., trace=GradeTrace())``; without a trace ``grade``
+    records nothing. Hops are indexed like ``CarPaths.street_ids`` (car ``i``
+    owns the hops ``offsets[i]:offsets[i + 1]`` of ``paths``):
+    ``arrival_ticks[h]`` is the second the car reached the end of the street
+    of hop ``h`` (-1 for its first street, where it starts queued, and the
+    finishing second for its last one) and ``departure_ticks[h]`` the second
+    it crossed the intersection there, ``NEVER`` when that did not happen in
+    the simulated horizon.
+
+    The queue of every street is kept as a series of changes: its length
+    became ``queue_lengths[s][k]`` at second ``queue_ticks[s][k]``, see
+    ``queue_length_series``.
     """
-    Create and return an artificial street.
 
-    Returns:
-        Street: An artificial street object with default values.
+    NEVER = 2 ** 31 - 1
+
+    def __init__(self):
+        self.paths = None
+        self.horizon = None
+        self.arrival_ticks = None
+        self.departure_ticks = None
+        self.queue_ticks = None
+        self.queue_lengths = None
+        self.result = None
+
+    def start(self, paths, horizon):
+        self.paths = paths
+        self.horizon = horizon
+        never = array('i', [self.NEVER])
+        self.arrival_ticks = never * len(paths.street_ids)
+        self.departure_ticks = never * len(paths.street_ids)
+        for i_car in range(len(paths)):
+            self.arrival_ticks[paths.offsets[i_car]] = -1
+        self.queue_ticks = [array('i') for _ in paths.streets]
+        self.queue_lengths = [array('i') for _ in paths.streets]
+
+    def queue_changed(self, street_id, t, length):
+        self.queue_ticks[street_id].append(t)
+        self.queue_lengths[street_id].append(length)
+
+    def queue_length_series(self, street_id):
+        """Queue length of the street at the start of every second of the horizon, as a list."""
+        series = [0] * (self.horizon + 1)
+        ticks = self.queue_ticks[street_id]
+        lengths = self.queue_lengths[street_id]
+        for k, t in enumerate(ticks):
+            end = ticks[k + 1] if k + 1 < len(ticks) else len(series)
+            series[t:end] = [lengths[k]] * (end - t)
+        return series
+
+    def to_dict(self):
+        """JSON-ready form: the columns as lists, the queues of the streets that ever had one, by name."""
+        streets = self.paths.streets
+        return {
+            "horizon": self.horizon,
+            "result": list(self.result) if self.result is not None else None,
+            "hop_offsets": self.paths.offsets.tolist(),
+            "hop_streets": [streets[street_id].name for street_id in self.paths.street_ids],
+            "arrival_ticks": [None if t == self.NEVER else t for t in self.arrival_ticks],
+            "departure_ticks": [None if t == self.NEVER else t for t in self.departure_ticks],
+            "queues": {streets[street_id].name: {"ticks": ticks.tolist(),
+                                                 "lengths": self.queue_lengths[street_id].tolist()}
+                       for street_id, ticks in enumerate(self.queue_ticks) if ticks},
+        }
+
+
+class CutoffResult(tuple):
     """
-    street = Street(
-        id=-1,
-        start=-1,
-        end=-1,
-        name="artificial_street",
-        duration=0,
-        driving_cars={},
-        waiting_cars=deque(),
-        arrival_times={},
-        departure_times={}
-    )
-    return street
-
-
-def reinit(streets, intersections):
-    # Reinitialize mutable data structures
-    for street in streets:
-        street.driving_cars.clear()
-        street.waiting_cars.clear()
-        street.arrival_times.clear()
-        street.departure_times.clear()
+    ``(score, completed_cars, avg_waiting)`` of a simulation ``grade`` stopped at its cutoff.
 
-    for intersection in intersections:
-        intersection.green_street = None
-        intersection.num_waiting_cars = 0
-        intersection.green_street_per_t_mod.clear()
-        intersection.schedule_duration = None
-        intersection.needs_updates = False
+    The score is an upper bound of the full score, no higher than the cutoff; the other two are the
+    values when the simulation stopped. Such results must not be cached as exact ones.
+    """
 
+    __slots__ = ()
 
 
-# Function to find a street by name
-def find_street_by_name(streets, name):
-    for street in streets:
-        if street.name == name:
-            return street
-    return None
 def grade(schedules, streets, intersections, paths, total_duration, bonus_points, yellow_phase,
-          duration_to_pass_through_a_traffic_light):
-    reinit(streets, intersections)  # we reset intersections and streets before performing a simulation
-    # save path copies to reset them after performing the simulation
-    paths_copy = [path.copy() for path in paths]
+          duration_to_pass_through_a_traffic_light, engine='python', state=None, cohorts=False, cutoff=None,
+          fidelity='full', setup=None, trace=None):
+    """
+    Simulate ``schedules`` and return ``(score, completed_cars, avg_waiting)``.
+
+    With ``cohorts`` the Python engine keeps the cars of the initial queues
+    in cohorts (see ``CarPaths.cohorts``) and only materializes a car when it
+    leaves its first street, so cars that never move cost nothing. The
+    result is the same. Other engines ignore ``cohorts``.
+
+    With a ``cutoff`` score the Python engine keeps an optimistic bound of
+    the final score: the score so far plus, for every unfinished car, the
+    score it would get if it never waited again (its remaining free-flow
+    time, see ``CarPaths.remaining_times``). As soon as the bound is not
+    above ``cutoff`` the schedule cannot beat it, the simulation stops and a
+    ``CutoffResult`` is returned. Other engines ignore ``cutoff``.
+
+    The cutoff is a bound, not a speedup: waiting cars are counted as if
+    they left at once, so between close schedules it only fires in the last
+    tenth of the horizon, and its bookkeeping costs more than that saves.
+
+    ``fidelity`` (a name of ``FIDELITY_LEVELS`` or a ``Fidelity``) trades
+    accuracy for speed. With ``sample < 1`` only a stratified sample of the
+    cars is simulated (``CarPaths.sample``) and the score and the completed
+    cars are scaled back by the sampling ratio, an estimate of the full
+    values. With ``horizon < 1`` only the first part of the horizon is
+    simulated, Python engine only: cars score as in the full simulation, so
+    the score is exactly that of the cars finished by then, a lower bound of
+    the full score. Only compare results graded at the same fidelity.
+
+    ``setup`` is the ``GradeSetup`` of the paths, ``CarPaths.grade_setup``
+    when it is missing or was built for other paths. Cohort mode needs none.
+
+    By default nothing but the result is recorded. Pass a ``GradeTrace`` as
+    ``trace`` to record the per-car arrival and departure times and the
+    queue length series of the simulation (Python engine only).
+    """
+    fidelity = fidelity_level(fidelity)
+    if fidelity.sample < 1:
+        paths = CarPaths.from_paths(streets, paths)
+        sampled = paths.sample(fidelity.sample)
+        scale = len(paths) / len(sampled)
+        result = grade(schedules, streets, intersections, sampled, total_duration, bonus_points, yellow_phase,
+                       duration_to_pass_through_a_traffic_light, engine=engine, cohorts=cohorts,
+                       cutoff=None if cutoff is None else cutoff / scale,
+                       fidelity=Fidelity(horizon=fidelity.horizon, sample=1.0), setup=setup, trace=trace)
+        scaled = (round(result[0] * scale), round(result[1] * scale), result[2])
+        return CutoffResult(scaled) if isinstance(result, CutoffResult) else scaled
+    horizon = total_duration
+    if fidelity.horizon < 1:
+        if engine != 'python':
+            raise ValueError(f"The {engine} engine cannot simulate a truncated horizon")
+        horizon = max(1, int(total_duration * fidelity.horizon))
+    if trace is not None and engine != 'python':
+        raise ValueError(f"The {engine} engine cannot record a trace")
+    if engine == 'numpy':
+        # Vectorized backend, returns the same (score, completed cars, average waiting) tuple.
+        from VectorizedSimulation import grade_vectorized
+        return grade_vectorized(schedules, streets, intersections, paths, total_duration, bonus_points,
+                                yellow_phase, duration_to_pass_through_a_traffic_light)
+    elif engine == 'event':
+        # Discrete-event backend, jumps between street arrivals and phase changes.
+        from EventSimulation import grade_events
+        return grade_events(schedules, streets, intersections, paths, total_duration, bonus_points,
+                            yellow_phase, duration_to_pass_through_a_traffic_light)
+    elif engine != 'python':
+        raise ValueError(f"Unknown simulation engine: {engine}")
+
+    # all run-time data lives in the state, the network objects and paths are left untouched
+    paths = CarPaths.from_paths(streets, paths)
+    path_street_ids = paths.street_ids
+    path_offsets = paths.offsets
+    if state is None:
+        state = SimulationState(streets, intersections, paths)
+    driving_cars_by_street = state.driving_cars
+    waiting_cars_by_street = state.waiting_cars
+    num_waiting_cars = state.num_waiting_cars
+    path_positions = state.path_positions
+    initial_waiting = state.initial_waiting
 
     num_cars_completed = 0
     sum_waiting_cars = 0
@@ -243,65 +918,78 @@ def grade(schedules, streets, intersections, paths, total_duration, bonus_points
     for schedule in schedules:
         intersection = intersections[schedule.i_intersection]
         intersection_ids_with_schedules.add(intersection.id)
-        first_street = streets[schedule.order[0]]
-        intersection.green_street = first_street
-        intersection.needs_updates = len(schedule.order) > 1
-        schedule_duration = 0
-        green_street_per_t_mod = intersection.green_street_per_t_mod
-        for street_id in schedule.order:
-            green_time = schedule.green_times[street_id]
-
-            # Calculate green time without considering yellow phase
-            green_time_without_yellow = green_time - yellow_phase
-
-            # Consider the usage factor of green time (set to 0.7 based on measurements)
-            # usage_factor=0.7
-            usage_factor = 1 / duration_to_pass_through_a_traffic_light
-            green_time_usage = int(usage_factor * green_time_without_yellow)
-
-            # Add streets with actual traffic during green time
-            for _ in range(green_time_usage):
-                green_street_per_t_mod.append(streets[street_id])
-            schedule_duration += green_time_usage
-
-            # Add artificial streets for the remaining green time
-            for _ in range(green_time - green_time_usage):
-                green_street_per_t_mod.append(get_artificial_street())
-            schedule_duration += (green_time - green_time_usage)
-
-        # Add artificial streets for pedestrian_phase_interval
-        for _ in range(intersection.pedestrian_phase_interval):
-            green_street_per_t_mod.append(get_artificial_street())
-        schedule_duration += intersection.pedestrian_phase_interval
-
-        # Add artificial streets for all_red_phase_interval
-        for _ in range(intersection.all_red_phase_interval):
-            green_street_per_t_mod.append(get_artificial_street())
-        schedule_duration += intersection.all_red_phase_interval
-
-        intersection.schedule_duration = schedule_duration
-        # for street_id in schedule.order:
-        #     green_time = schedule.green_times[street_id]
-        #     for _ in range(green_time):
-        #         green_street_per_t_mod.append(streets[street_id])
-        #     schedule_duration += green_time
-        # intersection.schedule_duration = schedule_duration
+        # single street schedules never switch, the first street stays green
+        state.green_street[intersection.id] = schedule.order[0]
+        state.needs_updates[intersection.id] = len(schedule.order) > 1
+        state.phase_tables[intersection.id] = compile_phase_table(schedule, intersection, yellow_phase,
+                                                                  duration_to_pass_through_a_traffic_light)
 
     # intersection_ids_with_waiting_cars is restricted to intersections
     # with schedules
     intersection_ids_with_waiting_cars = set()
-    for i_car, path in enumerate(paths):
-        street = path.popleft()
-        street.waiting_cars.append(i_car)
-        if street.end.id in intersection_ids_with_schedules:
-            intersection_ids_with_waiting_cars.add(street.end.id)
-        street.end.num_waiting_cars += 1
+    if cohorts:
+        car_cohorts = paths.cohorts()
+        for i_street, count in enumerate(car_cohorts.counts):
+            if count == 0:
+                continue
+            street = streets[i_street]
+            initial_waiting[i_street] = count
+            if street.end.id in intersection_ids_with_schedules:
+                intersection_ids_with_waiting_cars.add(street.end.id)
+            num_waiting_cars[street.end.id] += count
+    else:
+        if setup is None or setup.paths is not paths:
+            setup = paths.grade_setup()
+        path_positions[:] = setup.first_positions
+        for i_street, cars in setup.initial_queues:
+            street = streets[i_street]
+            waiting_cars_by_street[i_street].extend(cars)
+            if street.end.id in intersection_ids_with_schedules:
+                intersection_ids_with_waiting_cars.add(street.end.id)
+            num_waiting_cars[street.end.id] += len(cars)
+    if trace is not None:
+        trace.start(paths, horizon)
+        for i_street, cars in paths.grade_setup().initial_queues:
+            trace.queue_changed(i_street, 0, len(cars))
 
     street_ids_with_driving_cars = set()
     score = 0
 
+    if cutoff is not None:
+        # A car that can leave its queue for hop p at tick t at the earliest finishes at best with
+        # bonus + total_duration - t - remaining[p] points, if t <= total_duration - remaining[p] (its deadline).
+        # Waiting cars before their deadline are 'live': live_sum - t * live_waiting is their part of the
+        # bound. Driving cars keep the value they had when they left, summed in driving_bound.
+        remaining = paths.remaining_times()
+        expiring_cars = [0] * (total_duration + 1)
+        expiring_sum = [0] * (total_duration + 1)
+        live_waiting = 0
+        live_sum = 0
+        driving_bound = 0
+        for i_car in range(len(paths)):
+            hop = path_offsets[i_car] + 1
+            # The second street of the car, _readPaths guarantees every path has one.
+            assert hop < path_offsets[i_car + 1]
+            deadline = total_duration - remaining[hop]
+            if deadline >= 0:
+                value = bonus_points + total_duration - remaining[hop]
+                live_waiting += 1
+                live_sum += value
+                expiring_cars[deadline + 1] += 1
+                expiring_sum[deadline + 1] += value
+
     # Main simulation loop
-    for t in range(total_duration):
+    for t in range(horizon):
+        if cutoff is not None:
+            live_waiting -= expiring_cars[t]
+            live_sum -= expiring_sum[t]
+            bound = score + driving_bound + live_sum - t * live_waiting
+            if bound <= cutoff:
+                result = CutoffResult((bound, num_cars_completed,
+                                       sum_waiting_cars / waiting_cars_iteration if waiting_cars_iteration else 0.0))
+                if trace is not None:
+                    trace.result = result
+                return result
 
         # Drive across intersections
         # Store the ids of intersections that don't have waiting cars after this.
@@ -309,64 +997,59 @@ def grade(schedules, streets, intersections, paths, total_duration, bonus_points
         for i_intersection in intersection_ids_with_waiting_cars:
             intersection = intersections[i_intersection]
 
-            if intersection.needs_updates:
+            if state.needs_updates[i_intersection]:
                 # Update the green street
-                t_mod = t % intersection.schedule_duration
-                intersection.green_street = intersection.green_street_per_t_mod[t_mod]
-                # if(t_mod + yellow_phase < len(intersection.green_street_per_t_mod)):
-                #     if(intersection.green_street_per_t_mod[t_mod + yellow_phase].id == intersection.green_street_per_t_mod[t_mod].id):
-                #         intersection.green_street = intersection.green_street_per_t_mod[t_mod]
-
-            if intersection.green_street is None:
-                green_streets = []
-            else:
-                green_street = intersection.green_street
-                green_streets = [green_street]
-                if 'simultaneously_signal' in intersection.constraints:
-                    group_of_streets=intersection.constraints['simultaneously_signal']
-                    is_found=False
-                    for group in group_of_streets:
-                        if green_street.name in group:
-                            for street_name in group:
-                                if street_name!=green_street.name:
-                                    current_street=find_street_by_name(streets,street_name)
-                                    # if current_street is None:
-                                    #     print("Test")
-                                    # try:
-                                    #     if current_street == 'None':
-                                    #         continue
-                                    #     pass
-                                    # except Exception as e:
-                                    #     # Code that runs if any other exception occurs
-                                    #     print(f"An unexpected error occurred: {e}")
-                                    # else:
-                                    #     # Code that runs if no exceptions occur
-                                    #     print("No errors occurred")
-                                    # finally:
-                                    #     # Code that runs no matter what (whether an exception occurred or not)
-                                    #     print("This will always execute")
-
-                                    green_streets.append(current_street)
-                            is_found=True
-                        if is_found:
-                            break
-
-            for street in green_streets:
-                if len(street.waiting_cars) == 0:
+                phase_table = state.phase_tables[i_intersection]
+                state.green_street[i_intersection] = phase_table.green[t % phase_table.cycle]
+
+            green_street_id = state.green_street[i_intersection]
+            if green_street_id < 0:
+                # yellow loss, pedestrian or all-red second, no traffic can pass
+                continue
+
+            # the green street together with the streets signalled simultaneously with it
+            for street_id in intersection.signal_groups.get(green_street_id, (green_street_id,)):
+                waiting_cars = waiting_cars_by_street[street_id]
+                # cars of the initial queue (cohort mode only) wait in front of all later arrivals
+                queue_length = initial_waiting[street_id] + len(waiting_cars)
+                if queue_length == 0:
                     continue
-                waiting_cars = street.waiting_cars
                 waiting_cars_iteration = waiting_cars_iteration + 1
-                sum_waiting_cars = sum_waiting_cars + len(waiting_cars)
-                if len(waiting_cars) > 0:
+                sum_waiting_cars = sum_waiting_cars + queue_length
+                if queue_length > 0:
                     # Drive across the intersection
-                    waiting_car = waiting_cars.popleft()
-                    street.departure_times[waiting_car] = t
-                    next_street = paths[waiting_car].popleft()
-                    next_street.driving_cars[waiting_car] = next_street.duration
+                    if initial_waiting[street_id]:
+                        # release the next car of the current cohort
+                        cohort = car_cohorts.queues[street_id][state.cohort_index[street_id]]
+                        waiting_car = cohort[state.cohort_taken[street_id]]
+                        state.cohort_taken[street_id] += 1
+                        if state.cohort_taken[street_id] == len(cohort):
+                            state.cohort_index[street_id] += 1
+                            state.cohort_taken[street_id] = 0
+                        initial_waiting[street_id] -= 1
+                        path_positions[waiting_car] = path_offsets[waiting_car] + 1
+                    else:
+                        waiting_car = waiting_cars.popleft()
+                    if trace is not None:
+                        trace.departure_ticks[path_positions[waiting_car] - 1] = t
+                        trace.queue_changed(street_id, t, queue_length - 1)
+                    if cutoff is not None:
+                        hop = path_positions[waiting_car]
+                        deadline = total_duration - remaining[hop]
+                        if t <= deadline:
+                            value = bonus_points + total_duration - remaining[hop]
+                            live_waiting -= 1
+                            live_sum -= value
+                            expiring_cars[deadline + 1] -= 1
+                            expiring_sum[deadline + 1] -= value
+                            driving_bound += value - t
+                    next_street = streets[path_street_ids[path_positions[waiting_car]]]
+                    path_positions[waiting_car] += 1
+                    driving_cars_by_street[next_street.id][waiting_car] = next_street.duration
                     street_ids_with_driving_cars.add(next_street.id)
 
-                    intersection.num_waiting_cars -= 1
-                    if intersection.num_waiting_cars == 0:
+                    num_waiting_cars[i_intersection] -= 1
+                    if num_waiting_cars[i_intersection] == 0:
                         intersection_ids_to_remove.add(i_intersection)
 
         intersection_ids_with_waiting_cars.difference_update(intersection_ids_to_remove)
@@ -376,7 +1059,7 @@ def grade(schedules, streets, intersections, paths, total_duration, bonus_points
         street_ids_to_remove = set()
         for i_street in street_ids_with_driving_cars:
             street = streets[i_street]
-            driving_cars = street.driving_cars
+            driving_cars = driving_cars_by_street[i_street]
             for car in list(driving_cars):
                 # Update the "time to live" of this car, i.e. the remaining
                 # driving seconds.
@@ -387,15 +1070,31 @@ def grade(schedules, streets, intersections, paths, total_duration, bonus_points
                 elif ttl == 0:
                     # Reached the end of the street
                     del driving_cars[car]
-                    if len(paths[car]) == 0:
+                    if trace is not None:
+                        trace.arrival_ticks[path_positions[car] - 1] = t
+                    if path_positions[car] == path_offsets[car + 1]:
                         # car finished its path
                         num_cars_completed += 1
                         score += bonus_points
                         score += total_duration - t - 1
+                        if cutoff is not None:
+                            driving_bound -= bonus_points + total_duration - t - 1
                     else:
-                        street.waiting_cars.append(car)
-                        street.end.num_waiting_cars += 1
-                        street.arrival_times[car] = t + 1
+                        if cutoff is not None:
+                            hop = path_positions[car]
+                            deadline = total_duration - remaining[hop]
+                            if t + 1 <= deadline:
+                                value = bonus_points + total_duration - remaining[hop]
+                                driving_bound -= value - t - 1
+                                live_waiting += 1
+                                live_sum += value
+                                expiring_cars[deadline + 1] += 1
+                                expiring_sum[deadline + 1] += value
+                        waiting_cars_by_street[i_street].append(car)
+                        num_waiting_cars[street.end.id] += 1
+                        if trace is not None:
+                            trace.queue_changed(i_street, t + 1,
+                                                initial_waiting[i_street] + len(waiting_cars_by_street[i_street]))
                         intersection_id = street.end.id
                         if intersection_id in intersection_ids_with_schedules:
                             intersection_ids_with_waiting_cars.add(intersection_id)
@@ -406,14 +1105,97 @@ def grade(schedules, streets, intersections, paths, total_duration, bonus_points
                 street_ids_to_remove.add(i_street)
         street_ids_with_driving_cars.difference_update(street_ids_to_remove)
 
-    # The end of simulation, we reset the paths
-    for i_path in range(len(paths)):
-        paths[i_path] = paths_copy[i_path]
-    return score, num_cars_completed, sum_waiting_cars / waiting_cars_iteration
+    result = score, num_cars_completed, sum_waiting_cars / waiting_cars_iteration
+    if trace is not None:
+        trace.result = result
+    return result
+
+
+def grade_many(schedules_list, streets, intersections, paths, total_duration, bonus_points, yellow_phase,
+               duration_to_pass_through_a_traffic_light, engine='python', cohorts=False, cutoffs=None,
+               fidelity='full'):
+    """
+    Grade a batch of candidate schedules and return their ``(score, completed_cars, avg_waiting)`` in order.
+
+    The candidates are simulated back to back with ``grade``, sharing the
+    ``GradeSetup`` cached by the paths (``CarPaths.grade_setup``, the other
+    engines cache their compiled instance already) and the cached phase
+    tables of the intersection schedules they have in common. ``cutoffs``
+    optionally holds the cutoff of every candidate.
+    """
+    if cutoffs is None:
+        cutoffs = [None] * len(schedules_list)
+    paths = CarPaths.from_paths(streets, paths)
+    return [grade(schedules, streets, intersections, paths, total_duration, bonus_points, yellow_phase,
+                  duration_to_pass_through_a_traffic_light, engine=engine, cohorts=cohorts, cutoff=cutoff,
+                  fidelity=fidelity)
+            for schedules, cutoff in zip(schedules_list, cutoffs)]
+
+
+def schedule_fingerprint(schedules):
+    """
+    Canonical, hashable form of a schedule list.
+
+    Two schedule lists get the same fingerprint exactly when they describe the
+    same phase orders and green times, independent of the order of the
+    schedules in the list and of the insertion order of ``green_times``.
+    A ``ScheduleArray`` has its own, cheaper fingerprint, only comparable to
+    those of other ``ScheduleArray`` instances.
+    """
+    if isinstance(schedules, ScheduleArray):
+        return schedules.fingerprint()
+    return tuple(sorted((schedule.i_intersection,
+                         tuple(schedule.order),
+                         tuple(sorted(schedule.green_times.items())))
+                        for schedule in schedules))
+
+
+class FitnessCache:
+    """
+    Bounded LRU cache of ``grade`` results keyed by ``schedule_fingerprint``.
+
+    A ``max_size`` of 0 disables caching, lookups then only count misses.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries)
+        }
 
 
 def assertOrder(actual, constraint, name_to_i_street):
-    indices = [actual.index(name_to_i_street[c].id) if name_to_i_street[c].id in actual else -1 for c in constraint]
+    return assertOrderIds(actual, [name_to_i_street[c].id for c in constraint])
+
+
+def assertOrderIds(actual, constraint_ids):
+    indices = [actual.index(street_id) if street_id in actual else -1 for street_id in constraint_ids]
 
     for i in range(0, len(indices)):
         if indices[i] != -1:
@@ -432,12 +1214,9 @@ def assertOrder(actual, constraint, name_to_i_street):
 
 
 def assertOrderPhaseForSchedule(schedule, intersections, name_to_i_street):
-    if 'signal_phase_order' in intersections[schedule.i_intersection].constraints:
-        if (assertOrder(
-                schedule.order,
-                intersections[schedule.i_intersection].constraints['signal_phase_order'],
-                name_to_i_street) == False
-        ):
+    phase_order = intersections[schedule.i_intersection].phase_order
+    if phase_order:
+        if (assertOrderIds(schedule.order, phase_order) == False):
             return False
     return True
 
@@ -452,6 +1231,8 @@ def printSchedule(schedules, streets):
 
 
 def getPrintedSchedule(schedules, streets):
+    if isinstance(schedules, ScheduleArray):
+        schedules = schedules.to_schedules()
     result = f'{len(schedules)}\n'
     for schedule in schedules:
         result += f'{schedule.i_intersection}\n'
@@ -462,7 +1243,9 @@ def getPrintedSchedule(schedules, streets):
     return result
 
 
-def print_json_solution(patches, schedules, streets, intersections, file, code):
+def print_json_solution(patches, schedules, streets, intersections, file, code, profile=None):
+    if isinstance(schedules, ScheduleArray):
+        schedules = schedules.to_schedules()
     street_id_to_name = {}
     for street in streets:
         street_id_to_name[street.id] = street.name
@@ -514,5 +1297,7 @@ def print_json_solution(patches, schedules, streets, intersections, file, code):
         intersection["phases"] = phases
         solution["intersections"].append(intersection)
 
+    if profile is not None:
+        solution["profile"] = profile
 
     return json.dumps(solution)
\ No newline at end of file
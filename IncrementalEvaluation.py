@@ -0,0 +1,237 @@
+"""Incremental (delta) fitness evaluation for neighbourhood moves.
+
+A recruited bee only changes the schedules of one or a few intersections of
+its parent patch. ``trace_schedule`` simulates the parent once with the
+event engine and records every car's trajectory; ``grade_incremental`` then
+grades a neighbour by re-simulating only what the move can influence:
+
+* a changed intersection is simulated from the first second its released
+  streets differ from the parent's,
+* an intersection becomes "dirty" (simulated) as soon as one of its
+  incoming cars arrives at a different second than in the parent, i.e. when
+  a dirty intersection lets a car go earlier or later than the parent did,
+* every other car movement is taken from the parent trajectory.
+
+Score, completed cars and waiting statistics are the parent's plus the
+differences produced by the dirty part of the network, so the result is
+exactly what ``gl.grade`` returns for the neighbour.
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import accumulate
+
+import EventSimulation as es
+
+MATERIALIZE = 0
+WAKE = 1
+CHECK = 2
+ARRIVAL = 3
+REPLAY = 4
+
+
+def trace_schedule(schedules, streets, intersections, paths, total_duration, bonus_points, yellow_phase,
+                   duration_to_pass_through_a_traffic_light):
+    """Simulate ``schedules`` in full and return its trace for later delta evaluations."""
+    trace = es.SimulationTrace()
+    es.grade_events(schedules, streets, intersections, paths, total_duration, bonus_points, yellow_phase,
+                    duration_to_pass_through_a_traffic_light, trace=trace)
+
+    arrival_ticks = trace.arrival_ticks
+    departure_ticks = trace.departure_ticks
+    trace.street_arrivals = [[arrival_ticks[h] for h in hops] for hops in trace.street_hops]
+    trace.street_departures = [[departure_ticks[h] for h in hops] for hops in trace.street_hops]
+    trace.wake_count_prefix = {i: list(accumulate(counts, initial=0)) for i, counts in trace.wake_counts.items()}
+    trace.wake_sum_prefix = {i: list(accumulate(sums, initial=0)) for i, sums in trace.wake_sums.items()}
+    return trace
+
+
+def _released_at(t, table):
+    return table.released[bisect_right(table.starts, t % table.cycle) - 1]
+
+
+def _first_difference(parent, child, total_duration):
+    """First second at which two phase tables release different streets, or None.
+
+    Walks the phase boundaries of both tables, not every second. Unchanged
+    schedules share their cached table and are skipped at once.
+    """
+    if parent is child:
+        return None
+    t = 0
+    while t < total_duration:
+        parent_phase = bisect_right(parent.starts, t % parent.cycle) - 1
+        child_phase = bisect_right(child.starts, t % child.cycle) - 1
+        if parent.street_ids[parent_phase] != child.street_ids[child_phase]:
+            return t
+        t = min(_phase_end(t, parent, parent_phase), _phase_end(t, child, child_phase))
+    return None
+
+
+def _phase_end(t, table, phase):
+    # first second after t in another phase of the cycle (or the start of the next cycle)
+    base = t - t % table.cycle
+    return base + (table.starts[phase + 1] if phase + 1 < len(table.starts) else table.cycle)
+
+
+def grade_incremental(trace, schedules):
+    """Grade ``schedules`` as a neighbour of the schedule recorded in ``trace``.
+
+    Returns the same ``(score, completed_cars, avg_waiting)`` tuple as
+    ``gl.grade``. Falls back to a full simulation when the set of scheduled
+    intersections differs from the parent's.
+    """
+    network = trace.network
+    total_duration = trace.total_duration
+    bonus_points = trace.bonus_points
+    parent_phases = trace.phases_by_intersection
+    score, num_cars_completed, sum_waiting_cars, waiting_cars_iteration = trace.result
+
+    child_phases = {}
+    first_changes = []
+    for schedule in schedules:
+        phases = es.compile_phases(schedule, network, trace.yellow_phase,
+                                   trace.duration_to_pass_through_a_traffic_light)
+        child_phases[schedule.i_intersection] = phases
+        if schedule.i_intersection not in parent_phases:
+            break
+        t0 = _first_difference(parent_phases[schedule.i_intersection], phases, total_duration)
+        if t0 is not None:
+            first_changes.append((t0, schedule.i_intersection))
+    if child_phases.keys() != parent_phases.keys():
+        return es.grade_events(schedules, network.streets, network.intersections, network.paths, total_duration,
+                               bonus_points, trace.yellow_phase, trace.duration_to_pass_through_a_traffic_light,
+                               network=network)
+    if not first_changes:
+        return score, num_cars_completed, sum_waiting_cars / waiting_cars_iteration
+
+    durations = network.durations
+    street_end = network.street_end
+    hop_offsets = network.hop_offsets
+    hop_car = network.hop_car
+    hop_street = network.hop_street
+    arrival_ticks = trace.arrival_ticks
+    departure_ticks = trace.departure_ticks
+
+    waiting_cars = [deque() for _ in network.streets]
+    current_hop = {}
+    dirty = set()
+    departed = set()  # hops whose departure was simulated
+    claimed = set()  # hops the parent left at a second the neighbour did not
+    finish_changed = set()
+    wake_time = {}
+    events = []
+    sequence = 0
+
+    def push(t, kind, payload):
+        nonlocal sequence
+        heapq.heappush(events, (t, kind, sequence, payload))
+        sequence += 1
+
+    def wake_up(i_intersection, t):
+        t = es._next_green(t, child_phases[i_intersection], waiting_cars)
+        if t is None or t >= total_duration:
+            return
+        pending = wake_time.get(i_intersection)
+        if pending is not None and pending <= t:
+            return
+        wake_time[i_intersection] = t
+        push(t, WAKE, i_intersection)
+
+    def make_dirty(i_intersection, t, first_wake):
+        # Take over the parent's queues at second t, simulate from first_wake on.
+        nonlocal sum_waiting_cars, waiting_cars_iteration
+        if i_intersection in dirty or i_intersection not in child_phases:
+            return
+        dirty.add(i_intersection)
+        for street in network.intersections[i_intersection].incomings:
+            hops = trace.street_hops[street.id]
+            if not hops:
+                continue
+            lo = bisect_left(trace.street_departures[street.id], first_wake)
+            hi = bisect_left(trace.street_arrivals[street.id], t)
+            queue = waiting_cars[street.id]
+            for h in hops[lo:hi]:
+                queue.append(hop_car[h])
+                current_hop[hop_car[h]] = h
+            for h in hops[hi:]:
+                push(arrival_ticks[h], REPLAY, h)
+            for h in hops[lo:]:
+                if departure_ticks[h] < total_duration:
+                    push(departure_ticks[h], CHECK, h)
+        i_wake = bisect_left(trace.wake_ticks[i_intersection], first_wake)
+        count_prefix = trace.wake_count_prefix[i_intersection]
+        sum_prefix = trace.wake_sum_prefix[i_intersection]
+        waiting_cars_iteration -= count_prefix[-1] - count_prefix[i_wake]
+        sum_waiting_cars -= sum_prefix[-1] - sum_prefix[i_wake]
+        wake_up(i_intersection, first_wake)
+
+    def change_finish(car):
+        # Drop the parent's contribution of a car that does not finish as in the parent.
+        nonlocal score, num_cars_completed
+        if car in finish_changed:
+            return
+        finish_changed.add(car)
+        t = arrival_ticks[hop_offsets[car + 1] - 1]
+        if t < total_duration:
+            num_cars_completed -= 1
+            score -= bonus_points + total_duration - t - 1
+
+    for t0, i_intersection in first_changes:
+        push(t0, MATERIALIZE, i_intersection)
+
+    while events:
+        t, kind, _, payload = heapq.heappop(events)
+        if t >= total_duration:
+            break
+
+        if kind == MATERIALIZE:
+            make_dirty(payload, t, t)
+        elif kind == WAKE:
+            if wake_time.get(payload) != t:
+                continue
+            del wake_time[payload]
+            for street_id in _released_at(t, child_phases[payload]):
+                queue = waiting_cars[street_id]
+                if not queue:
+                    continue
+                waiting_cars_iteration += 1
+                sum_waiting_cars += len(queue)
+                car = queue.popleft()
+                h = current_hop.pop(car)
+                departed.add(h)
+                arrival = t + durations[hop_street[h + 1]] - 1
+                if h + 1 == hop_offsets[car + 1] - 1:
+                    if t != departure_ticks[h]:
+                        change_finish(car)
+                        if arrival < total_duration:
+                            num_cars_completed += 1
+                            score += bonus_points + total_duration - arrival - 1
+                else:
+                    if t != departure_ticks[h]:
+                        make_dirty(street_end[hop_street[h + 1]], t, t + 1)
+                    if arrival < total_duration:
+                        push(arrival, ARRIVAL, h + 1)
+            wake_up(payload, t + 1)
+        elif kind == CHECK:
+            if payload in departed:
+                continue
+            claimed.add(payload)
+            car = hop_car[payload]
+            if payload + 1 == hop_offsets[car + 1] - 1:
+                change_finish(car)
+            else:
+                make_dirty(street_end[hop_street[payload + 1]], t, t + 1)
+        else:
+            if kind == REPLAY and (payload - 1 in departed or payload - 1 in claimed):
+                continue
+            street_id = hop_street[payload]
+            i_intersection = street_end[street_id]
+            if i_intersection not in dirty:
+                continue
+            car = hop_car[payload]
+            waiting_cars[street_id].append(car)
+            current_hop[car] = payload
+            wake_up(i_intersection, t + 1)
+
+    return score, num_cars_completed, sum_waiting_cars / waiting_cars_iteration
@@ -0,0 +1,323 @@
+"""Synthetic problem instances for stress and scaling tests.
+
+Writes instances in the JSON schema ``gl.readInput`` consumes, on networks of
+any size:
+
+* ``grid``: intersections on a rectangular grid, two-way roads between
+  neighbours;
+* ``planar``: a jittered grid with one random diagonal per cell, thinned out
+  to a random spanning tree plus a share of the remaining roads. The network
+  stays planar and connected.
+
+Every road X -> Y becomes one street per movement at Y, named ``X_Y_Z`` like
+the streets of the real instances (U-turns only at dead ends). The movements
+of each approach, paired with the opposite approach where there is one, form
+a ``simultaneously_signal`` group; a share of the intersections also gets a
+``signal_phase_order`` constraint between two of its groups.
+
+Cars drive the fastest route between an origin and a destination drawn from
+Zipf-like popularity weights, so a few hot spots attract most of the demand
+and many cars share a route, as in real traffic. The same seed always gives
+the same instance.
+
+Example usage:
+    python InstanceGenerator.py --output input/grid_1k.json --intersections 1000 --cars 1000000
+    python InstanceGenerator.py --output input/planar.json --topology planar --intersections 200 --seed 7
+
+Aliases:
+    -o, --output
+    -n, --intersections
+    -c, --cars
+"""
+import argparse
+import heapq
+import json
+import math
+import random
+from bisect import bisect_left
+from itertools import accumulate
+
+GRID = 'grid'
+PLANAR = 'planar'
+TOPOLOGIES = (GRID, PLANAR)
+
+SIMULATION = {
+    "duration": 600,
+    "bonus": 0,
+    "duration_to_pass_through_a_traffic_light": 1.42,
+    "yellow_phase": 4,
+    "limit_on_minimum_cycle_length": 60,
+    "limit_on_maximum_cycle_length": 120,
+    "limit_on_minimum_green_phase_duration": 19,
+    "limit_on_maximum_green_phase_duration": 74,
+}
+
+# Green phases per intersection, more would not fit the maximum cycle with minimum green times.
+MAX_GROUPS = 4
+
+
+def _grid_points(num_intersections, rng, jitter):
+    cols = max(1, round(math.sqrt(num_intersections)))
+    points = []
+    cells = {}
+    for i in range(num_intersections):
+        row, col = divmod(i, cols)
+        cells[row, col] = i
+        points.append((col + rng.uniform(-jitter, jitter), row + rng.uniform(-jitter, jitter)))
+    return points, cells
+
+
+def _grid_roads(cells):
+    roads = []
+    for (row, col), i in cells.items():
+        for neighbour in ((row, col + 1), (row + 1, col)):
+            if neighbour in cells:
+                roads.append((i, cells[neighbour]))
+    return roads
+
+
+def _planar_roads(cells, rng, keep):
+    roads = _grid_roads(cells)
+    for (row, col), i in cells.items():
+        corners = [cells.get((row, col + 1)), cells.get((row + 1, col)), cells.get((row + 1, col + 1))]
+        if None in corners:
+            continue
+        # One diagonal per cell, so no two roads cross.
+        roads.append((i, corners[2]) if rng.random() < 0.5 else (corners[0], corners[1]))
+
+    # Random spanning tree first, it keeps the network connected whatever else is dropped.
+    rng.shuffle(roads)
+    parent = list(range(len(cells)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    kept = []
+    for a, b in roads:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[root_a] = root_b
+            kept.append((a, b))
+        elif rng.random() < keep:
+            kept.append((a, b))
+    return kept
+
+
+def _zipf_weights(n, skew, rng):
+    weights = [1 / (rank + 1) ** skew for rank in range(n)]
+    rng.shuffle(weights)
+    return list(accumulate(weights))
+
+
+def _draw(cumulative, rng):
+    return bisect_left(cumulative, rng.random() * cumulative[-1])
+
+
+def _signal_groups(i, incoming, points, rng):
+    """Partition the approaches to ``i`` into at most ``MAX_GROUPS`` groups of approaches."""
+    def angle(j):
+        return math.atan2(points[j][1] - points[i][1], points[j][0] - points[i][0])
+
+    approaches = sorted(incoming, key=angle)
+    groups = []
+    while approaches:
+        a = approaches.pop(0)
+        # Pair with the approach closest to straight across, if it is within 45 degrees of it.
+        best = None
+        for b in approaches:
+            deviation = abs(abs(angle(a) - angle(b)) - math.pi)
+            if deviation < math.pi / 4 and (best is None or deviation < best[0]):
+                best = (deviation, b)
+        if best is None:
+            groups.append([a])
+        else:
+            approaches.remove(best[1])
+            groups.append([a, best[1]])
+    while len(groups) > MAX_GROUPS:
+        groups.sort(key=len)
+        groups[1].extend(groups.pop(0))
+    rng.shuffle(groups)
+    return groups
+
+
+class SyntheticInstance:
+    """
+    Network, constraints and demand of one generated instance.
+
+    The cars are generated lazily by ``cars`` so that instances with millions of cars are written
+    without holding them in memory.
+    """
+
+    def __init__(self, topology=GRID, num_intersections=100, num_cars=10000, seed=0, skew=1.0,
+                 min_path_length=2, max_path_length=None, keep=0.5, phase_order_share=0.2,
+                 pedestrian_share=0.2, all_red_share=0.1, duration=SIMULATION["duration"]):
+        if topology not in TOPOLOGIES:
+            raise ValueError(f"Unknown topology {topology!r}, expected one of {TOPOLOGIES}")
+        if num_intersections < 2:
+            raise ValueError("At least two intersections are needed")
+        if min_path_length < 2:
+            raise ValueError("Paths need at least two streets, the first one only holds the car at the start")
+        self.num_cars = num_cars
+        self.seed = seed
+        self.skew = skew
+        self.min_path_length = min_path_length
+        self.max_path_length = max_path_length
+        self.duration = duration
+        rng = random.Random(seed)
+
+        self.points, cells = _grid_points(num_intersections, rng, 0.3 if topology == PLANAR else 0.0)
+        roads = _grid_roads(cells) if topology == GRID else _planar_roads(cells, rng, keep)
+
+        self.neighbours = [[] for _ in range(num_intersections)]
+        for a, b in roads:
+            self.neighbours[a].append(b)
+            self.neighbours[b].append(a)
+        for adjacent in self.neighbours:
+            adjacent.sort()
+
+        # Travel time of a road in seconds, about 25 s for a grid edge like the streets of the real city.
+        self.road_time = {}
+        for a, b in roads:
+            length = math.dist(self.points[a], self.points[b])
+            time = max(5, round(25 * length * rng.uniform(0.8, 1.25)))
+            self.road_time[a, b] = self.road_time[b, a] = time
+
+        self.intersections = [{"id": i, "name": f"I{i}",
+                               "pedestrian_phase_interval": rng.randint(10, 30) if rng.random() < pedestrian_share else 0,
+                               "all_red_phase_interval": rng.randint(3, 4) if rng.random() < all_red_share else 0}
+                              for i in range(num_intersections)]
+
+        self.streets = []
+        for via in range(num_intersections):
+            for start in self.neighbours[via]:
+                for end in self._turns(start, via):
+                    self.streets.append({"start": start, "end": via, "name": self._street_name(start, via, end),
+                                         "time": self.road_time[start, via]})
+
+        self.constraints = []
+        for via in range(num_intersections):
+            groups = _signal_groups(via, self.neighbours[via], self.points, rng)
+            representatives = []
+            for approaches in groups:
+                names = [self._street_name(start, via, end) for start in approaches for end in self._turns(start, via)]
+                representatives.append(names[0])
+                self.constraints.append({"type": "simultaneously_signal", "intersection_name": f"I{via}",
+                                         "streets": names})
+            if len(representatives) > 1 and rng.random() < phase_order_share:
+                self.constraints.append({"type": "signal_phase_order", "intersection_name": f"I{via}",
+                                         "streets": rng.sample(representatives, 2)})
+
+    def _turns(self, start, via):
+        outgoing = [end for end in self.neighbours[via] if end != start]
+        # U-turns only where there is no other way out.
+        return outgoing or [start]
+
+    def _street_name(self, start, via, end):
+        return f"I{start}_I{via}_I{end}"
+
+    def _fastest_routes(self, origin):
+        """Predecessor of every intersection on the fastest route from ``origin``, and the hop counts."""
+        predecessor = {origin: None}
+        hops = {origin: 0}
+        best = {origin: 0}
+        heap = [(0, origin)]
+        while heap:
+            time, a = heapq.heappop(heap)
+            if time > best[a]:
+                continue
+            for b in self.neighbours[a]:
+                t = time + self.road_time[a, b]
+                if t < best.get(b, math.inf):
+                    best[b] = t
+                    predecessor[b] = a
+                    hops[b] = hops[a] + 1
+                    heapq.heappush(heap, (t, b))
+        return predecessor, hops
+
+    def cars(self):
+        """Yield the cars as ``{"path_length", "path"}`` dicts, the same ones on every call."""
+        rng = random.Random(f"{self.seed}-cars")
+        num_intersections = len(self.intersections)
+        origins = _zipf_weights(num_intersections, self.skew, rng)
+        destinations = _zipf_weights(num_intersections, self.skew, rng)
+        max_length = self.max_path_length or math.inf
+        trees = {}
+        routes = {}
+
+        for _ in range(self.num_cars):
+            for _ in range(10000):
+                origin = _draw(origins, rng)
+                destination = _draw(destinations, rng)
+                if origin == destination:
+                    continue
+                if origin not in trees:
+                    trees[origin] = self._fastest_routes(origin)
+                predecessor, hops = trees[origin]
+                if self.min_path_length <= hops[destination] <= max_length:
+                    break
+            else:
+                raise ValueError(f"No routes of {self.min_path_length} to {max_length} streets in this network")
+
+            path = routes.get((origin, destination))
+            if path is None:
+                nodes = [destination]
+                while nodes[-1] != origin:
+                    nodes.append(predecessor[nodes[-1]])
+                nodes.reverse()
+                # The last street of a path needs a movement too, leave the destination the first way possible.
+                nodes.append(self._turns(nodes[-2], destination)[0])
+                path = [self._street_name(*nodes[i:i + 3]) for i in range(len(nodes) - 2)]
+                routes[origin, destination] = path
+            yield {"path_length": len(path), "path": path}
+
+    def simulation(self):
+        return {**SIMULATION, "duration": self.duration, "intersections": len(self.intersections),
+                "streets": len(self.streets), "cars": self.num_cars}
+
+    def write(self, output_file_path):
+        """Write the instance as JSON, streaming the cars."""
+        with open(output_file_path, 'w') as f:
+            f.write('{"simulation": ' + json.dumps(self.simulation()))
+            f.write(',\n"intersections": ' + json.dumps(self.intersections))
+            f.write(',\n"streets": ' + json.dumps(self.streets))
+            f.write(',\n"cars": [')
+            for i, car in enumerate(self.cars()):
+                f.write(',\n' if i else '\n')
+                f.write(json.dumps(car))
+            f.write('\n],\n"constraints": ' + json.dumps(self.constraints) + '}\n')
+
+
+def main(output_file_path, topology, num_intersections, num_cars, seed, skew, min_path_length, max_path_length, keep,
+         duration):
+    instance = SyntheticInstance(topology, num_intersections, num_cars, seed, skew=skew,
+                                 min_path_length=min_path_length, max_path_length=max_path_length, keep=keep,
+                                 duration=duration)
+    instance.write(output_file_path)
+    print(f'Wrote {topology} instance with {len(instance.intersections)} intersections, '
+          f'{len(instance.streets)} streets, {num_cars} cars and {len(instance.constraints)} constraints '
+          f'to {output_file_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', type=str, required=True)
+    parser.add_argument('--topology', type=str, choices=TOPOLOGIES, default=GRID)
+    parser.add_argument('-n', '--intersections', type=int, default=100)
+    parser.add_argument('-c', '--cars', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent of origin and destination popularity, 0 for uniform demand')
+    parser.add_argument('--min-path-length', type=int, default=2)
+    parser.add_argument('--max-path-length', type=int, default=None)
+    parser.add_argument('--keep', type=float, default=0.5,
+                        help='share of the roads beyond a spanning tree kept in a planar network')
+    parser.add_argument('--duration', type=int, default=SIMULATION["duration"])
+
+    args = parser.parse_args()
+    if args.min_path_length < 2:
+        parser.error('--min-path-length must be at least 2')
+    main(args.output, args.topology, args.intersections, args.cars, args.seed, args.skew, args.min_path_length,
+         args.max_path_length, args.keep, args.duration)
@@ -0,0 +1,132 @@
+"""Registry of parsed problem instances keyed by the content hash of the input file.
+
+Clients send the same city network over and over. ``InstanceRegistry.load``
+returns the tuple of ``gl.readInput`` for an input file, parsing a given
+content only once: parsed instances are kept in memory (LRU) and, when a
+directory is given, as pickle snapshots on disk that load several times
+faster than parsing the JSON again. Loading a snapshot runs ``pickle``,
+so the directory must only be writable by this user: it is created with
+mode 0700 and refused when another user owns it (``private_directory``).
+
+Instances are shared between callers and must be treated as read-only.
+"""
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import traceback
+from collections import OrderedDict
+
+import GlobalFunctions as gl
+
+# Bump when the layout of the parsed instance changes, older snapshots are then parsed again.
+SNAPSHOT_VERSION = 5
+
+
+def private_directory(directory):
+    """
+    Create ``directory`` with mode 0700 if missing and make sure only this user can write to it.
+
+    Raises ``PermissionError`` for a symlink or a directory owned by another user, files in there
+    could have been planted by them.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid():
+        raise PermissionError(f"{directory} is not a directory owned by this user")
+    if stat.S_IMODE(status.st_mode) & 0o077:
+        os.chmod(directory, 0o700)
+    return directory
+
+
+def instance_key(data):
+    """Content hash of the raw bytes of an input file."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class InstanceRegistry:
+    """
+    LRU of at most ``max_size`` parsed instances, backed by snapshots in ``directory``.
+
+    ``directory`` None keeps instances in memory only.
+    """
+
+    def __init__(self, max_size=8, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.snapshot_hits = 0
+        self.misses = 0
+        if directory is not None:
+            private_directory(directory)
+
+    def load(self, input_file_path):
+        """Return the ``gl.readInput`` tuple for ``input_file_path``."""
+        with open(input_file_path, 'rb') as f:
+            key = instance_key(f.read())
+
+        with self.lock:
+            instance = self.entries.get(key)
+            if instance is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return instance
+
+        instance = self._read_snapshot(key)
+        if instance is None:
+            instance = gl.readInput(input_file_path)
+            self._write_snapshot(key, instance)
+            with self.lock:
+                self.misses += 1
+        else:
+            with self.lock:
+                self.snapshot_hits += 1
+
+        with self.lock:
+            self.entries[key] = instance
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return instance
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "snapshot_hits": self.snapshot_hits, "misses": self.misses,
+                    "size": len(self.entries)}
+
+    def _snapshot_path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def _read_snapshot(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._snapshot_path(key), 'rb') as f:
+                version, instance = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # A damaged or foreign snapshot is not fatal, the input is parsed again.
+            traceback.print_exc()
+            return None
+        if version != SNAPSHOT_VERSION:
+            return None
+        return instance
+
+    def _write_snapshot(self, key, instance):
+        if self.directory is None:
+            return
+        # Write to a temporary file first, a concurrent reader must never see a partial snapshot.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((SNAPSHOT_VERSION, instance), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._snapshot_path(key))
+        except Exception:
+            traceback.print_exc()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
@@ -0,0 +1,144 @@
+"""Island-model BeeHive.
+
+Runs several independent hives, one per process, each with its own
+population of patches. Every ``migration_interval`` iterations a hive sends
+copies of its best patches to its neighbours and takes in whatever
+immigrants have arrived, without waiting for the other hives. Hives talk
+over one inbox queue each, so there is no central process in the loop.
+
+Run it from the command line with
+``python IslandModel.py -i input/input.json -o output/output.json --islands 4``.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+from time import time
+
+import GlobalFunctions as gl
+from BeeHiveOptimization import BeeHive, Patch, sortKey, writeOutputToFile
+
+TOPOLOGIES = ('ring', 'full')
+
+
+def neighbours(island, islands, topology):
+    """Islands that ``island`` sends its migrants to."""
+    if topology == 'ring':
+        return [(island + 1) % islands] if islands > 1 else []
+    elif topology == 'full':
+        return [other for other in range(islands) if other != island]
+    raise ValueError(f"Unknown migration topology: {topology}")
+
+
+def _run_island(island, islands, topology, migration_interval, migrants, seed, inboxes, results, args, kwargs):
+    random.seed(int.from_bytes(os.urandom(8), 'big') if seed is None else seed + island)
+    targets = neighbours(island, islands, topology)
+
+    def migrate(countIterations, patches):
+        if countIterations % migration_interval != 0:
+            return []
+        best = sorted(patches, reverse=True, key=sortKey)[:migrants]
+        for target in targets:
+            inboxes[target].put([(patch.score, patch.scout, patch.cars, patch.avg) for patch in best])
+        immigrants = []
+        while True:
+            try:
+                batch = inboxes[island].get_nowait()
+            except queue.Empty:
+                break
+            immigrants.extend(Patch(score, scout, cars=cars, avg=avg) for score, scout, cars, avg in batch)
+        return immigrants
+
+    try:
+        schedule, score, cars, avg, _ = BeeHive(*args, migrate=migrate, **kwargs)
+        results.put((island, score, schedule, cars, avg))
+    finally:
+        # Migrants nobody reads any more must not keep this process alive.
+        for inbox in inboxes:
+            inbox.cancel_join_thread()
+
+
+def IslandBeeHive(streets, intersections, paths, total_duration, bonus_points, terminated_time, yellow_phase,
+                  name_to_i_street, limit_on_minimum_green_phase_duration, limit_on_maximum_green_phase_duration,
+                  limit_on_minimum_cycle_length, limit_on_maximum_cycle_length,
+                  duration_to_pass_through_a_traffic_light, i_id_to_intersection, output_file_path, use_seed=False,
+                  solution_file_path=None, execution_time=10, islands=4, migration_interval=5, migrants=2,
+                  topology='ring', seed=None, **kwargs):
+    """Run ``islands`` BeeHive processes with periodic migration.
+
+    Takes the same arguments as ``BeeHive`` (extra keyword arguments are
+    passed on to every hive) and returns the same tuple, built from the best
+    patch over all islands.
+    """
+    if topology not in TOPOLOGIES:
+        raise ValueError(f"Unknown migration topology: {topology}")
+    args = (streets, intersections, paths, total_duration, bonus_points, terminated_time, yellow_phase,
+            name_to_i_street, limit_on_minimum_green_phase_duration, limit_on_maximum_green_phase_duration,
+            limit_on_minimum_cycle_length, limit_on_maximum_cycle_length, duration_to_pass_through_a_traffic_light,
+            i_id_to_intersection, output_file_path, use_seed, solution_file_path, execution_time)
+
+    inboxes = [multiprocessing.Queue() for _ in range(islands)]
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_run_island,
+                                         args=(island, islands, topology, migration_interval, migrants, seed,
+                                               inboxes, results, args, kwargs))
+                 for island in range(islands)]
+    for process in processes:
+        process.start()
+
+    patches = []
+    try:
+        for _ in processes:
+            while True:
+                try:
+                    _, score, scout, cars, avg = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes) and results.empty():
+                        raise RuntimeError("An island process exited without a result")
+            patches.append(Patch(score, scout, cars=cars, avg=avg))
+    finally:
+        for process in processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+    patches.sort(reverse=True, key=sortKey)
+    jsonFileInput = writeOutputToFile(patches, execution_time, None, None, None, None, None, None, None, None, None,
+                                      None, time(), output_file_path, streets, intersections)
+    return patches[0].scout, patches[0].score, patches[0].cars, patches[0].avg, jsonFileInput
+
+
+def main(input_file_path, output_file_path, execution_time, islands, migration_interval, migrants, topology, seed,
+         engine):
+    total_duration, bonus_points, intersections, streets, name_to_i_street, paths, \
+        duration_to_pass_through_a_traffic_light, yellow_phase, limit_on_minimum_cycle_length, \
+        limit_on_maximum_cycle_length, limit_on_minimum_green_phase_duration, \
+        limit_on_maximum_green_phase_duration, i_id_to_intersection = gl.readInput(input_file_path)
+    _, score, cars, avg, resultJSON = IslandBeeHive(
+        streets, intersections, paths, total_duration, bonus_points, time(), yellow_phase, name_to_i_street,
+        limit_on_minimum_green_phase_duration, limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length,
+        limit_on_maximum_cycle_length, duration_to_pass_through_a_traffic_light, i_id_to_intersection,
+        output_file_path, execution_time=execution_time, islands=islands, migration_interval=migration_interval,
+        migrants=migrants, topology=topology, seed=seed, engine=engine)
+    with open(output_file_path, 'w') as f:
+        f.write(resultJSON)
+    print(f'Score {score}, {cars} cars finished, average {avg}, written to {output_file_path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='input/input.json')
+    parser.add_argument('-o', '--output', type=str, default='output/output.json')
+    parser.add_argument('-t', '--time', type=float, default=10, help='seconds every island searches')
+    parser.add_argument('--islands', type=int, default=4)
+    parser.add_argument('--migration-interval', type=int, default=5, help='iterations between migrations')
+    parser.add_argument('--migrants', type=int, default=2, help='best patches sent to every neighbour')
+    parser.add_argument('--topology', type=str, choices=TOPOLOGIES, default='ring')
+    parser.add_argument('--seed', type=int, default=None, help='island k seeds random with seed + k')
+    parser.add_argument('--engine', type=str, choices=('python', 'numpy', 'event'), default='python')
+
+    args = parser.parse_args()
+    main(args.input, args.output, args.time, args.islands, args.migration_interval, args.migrants, args.topology,
+         args.seed, args.engine)
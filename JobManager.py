@@ -0,0 +1,389 @@
+"""Background optimization jobs for the API.
+
+``JobManager.submit`` stores the uploaded instance in a temporary directory
+of its own and returns a ``Job`` at once. A bounded thread pool starts at
+most ``max_jobs`` jobs at a time, each in a separate process so that jobs
+really run in parallel and a running job can be cancelled by terminating
+its process. Finished jobs keep their result in memory until they are
+deleted or pushed out by newer ones.
+
+While a job runs, BeeHive reports the best patch of every iteration through
+the job's result queue, the job keeps the last ``PROGRESS_HISTORY`` of them.
+``JobManager.events`` follows these reports, and
+``JobManager.stop`` asks the job to finish early with its best solution so far.
+With ``metrics`` (an ``OptimizationMetrics``) every running job is tracked
+there from these reports.
+
+With a ``checkpoint_directory`` every job checkpoints its population there
+(see ``Checkpoint``), under its job id. The checkpoint outlives the job and
+the server, a new job can resume from it with ``submit(..., resume=job_id)``
+until the job it belongs to is deleted. Only the ``max_checkpoints`` newest
+checkpoints are kept, including those left by earlier servers.
+"""
+import json
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from InstanceRegistry import private_directory
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINISHED = (DONE, FAILED, CANCELLED)
+
+PROGRESS = 'progress'
+# Progress reports kept per job, for subscribers that fall behind.
+PROGRESS_HISTORY = 100
+
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class Job:
+    def __init__(self, job_id, directory, timeout, workers, checkpoint_path=None, resume=None, resume_path=None):
+        self.id = job_id
+        self.directory = directory
+        self.timeout = timeout
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        # id of the job whose checkpoint this one continues
+        self.resume = resume
+        self.resume_path = resume_path
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.future = None
+        self.process = None
+        self.stop_requested = None
+        self.progress = deque(maxlen=PROGRESS_HISTORY)
+        # Number of progress reports received so far, the sequence number of the next one.
+        self.reports = 0
+        self.tracker = None
+
+    @property
+    def input_file_path(self):
+        return os.path.join(self.directory, 'input.json')
+
+    @property
+    def output_file_path(self):
+        return os.path.join(self.directory, 'output.json')
+
+    def to_dict(self):
+        job = {
+            "id": self.id,
+            "status": self.status,
+            "timeout": self.timeout,
+            "workers": self.workers,
+            "checkpoint": self.id if self.checkpoint_path is not None else None,
+            "resumed_from": self.resume,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": self.progress[-1] if self.progress else None,
+        }
+        if self.status == DONE:
+            job["result"] = self.result
+        elif self.status == FAILED:
+            job["error"] = self.error
+        return job
+
+
+def _optimize(input_file_path, output_file_path, timeout, workers, results, stop_requested, instance=None,
+              checkpoint_path=None, checkpoint_interval=60, resume=None):
+    # Runs in the job process, reports ('progress', report) per iteration and then ('done', result) or
+    # ('failed', message).
+    import GlobalFunctions as gl
+    from BeeHiveOptimization import BeeHive
+
+    # Cancelling terminates this process, exit normally so BeeHive shuts its worker pool down.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        start = time()
+
+        def progress(report):
+            results.put((PROGRESS, report))
+            return stop_requested.is_set()
+
+        total_duration, bonus_points, intersections, streets, name_to_i_street, paths, \
+            duration_to_pass_through_a_traffic_light, yellow_phase, limit_on_minimum_cycle_length, \
+            limit_on_maximum_cycle_length, limit_on_minimum_green_phase_duration, \
+            limit_on_maximum_green_phase_duration, i_id_to_intersection = \
+            gl.readInput(input_file_path) if instance is None else instance
+        schedule, score, cars, avg, resultJSON = BeeHive(streets, intersections, paths, total_duration, bonus_points,
+                                                         start, yellow_phase, name_to_i_street,
+                                                         limit_on_minimum_green_phase_duration,
+                                                         limit_on_maximum_green_phase_duration,
+                                                         limit_on_minimum_cycle_length, limit_on_maximum_cycle_length,
+                                                         duration_to_pass_through_a_traffic_light,
+                                                         i_id_to_intersection, output_file_path,
+                                                         execution_time=timeout or 10, workers=workers,
+                                                         progress=progress, checkpoint_path=checkpoint_path,
+                                                         checkpoint_interval=checkpoint_interval, resume=resume)
+        solution = json.loads(resultJSON)
+        results.put((DONE, {"score": score, "cars": cars, "avg": avg, "profile": solution.pop("profile", None),
+                            "solution": solution}))
+    except Exception as e:
+        traceback.print_exc()
+        results.put((FAILED, str(e)))
+
+
+class JobManager:
+    """
+    Runs at most ``max_jobs`` optimization jobs at a time and keeps ``max_finished`` finished ones.
+
+    With an ``InstanceRegistry`` in ``instances`` inputs are parsed in this process, once per content, and
+    handed to the job processes. With a ``checkpoint_directory``, a private directory (see
+    ``private_directory``), jobs write a checkpoint every ``checkpoint_interval`` seconds and when they end.
+    """
+
+    def __init__(self, max_jobs=2, max_finished=100, instances=None, metrics=None, checkpoint_directory=None,
+                 checkpoint_interval=60, max_checkpoints=100):
+        self.max_finished = max_finished
+        self.instances = instances
+        self.metrics = metrics
+        self.checkpoint_directory = checkpoint_directory
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='job')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        # Notified whenever a job reports progress or finishes.
+        self.changed = threading.Condition(self.lock)
+        if checkpoint_directory is not None:
+            private_directory(checkpoint_directory)
+            self._prune_checkpoints()
+
+    def submit(self, file, timeout=10, workers=0, resume=None):
+        """
+        Save the uploaded ``file`` to a new job directory and queue the job.
+
+        ``resume`` is the id of a job whose checkpoint the new job continues, see ``checkpoint_path``.
+        """
+        resume_path = None
+        if resume is not None:
+            resume_path = self.checkpoint_path(resume)
+            if resume_path is None:
+                raise ValueError(f"No checkpoint for job {resume}")
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, tempfile.mkdtemp(prefix='job-'), timeout, workers,
+                  checkpoint_path=None if self.checkpoint_directory is None
+                  else os.path.join(self.checkpoint_directory, job_id + '.checkpoint'),
+                  resume=resume, resume_path=resume_path)
+        try:
+            file.save(job.input_file_path)
+        except Exception:
+            shutil.rmtree(job.directory, ignore_errors=True)
+            raise
+        with self.lock:
+            self.jobs[job.id] = job
+            self._forget_finished()
+            job.future = self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def checkpoint_path(self, job_id):
+        """Path of the checkpoint of a job, also of one run before a restart, or None if there is none."""
+        if self.checkpoint_directory is None or not JOB_ID.match(job_id):
+            return None
+        path = os.path.join(self.checkpoint_directory, job_id + '.checkpoint')
+        return path if os.path.exists(path) else None
+
+    def delete(self, job_id):
+        """Cancel a queued or running job, or forget a finished one. Returns the job or None."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status == QUEUED:
+                job.future.cancel()
+                self._finish(job, CANCELLED)
+            elif job.status == RUNNING:
+                # _run notices the dead process, or the cancellation before the start, and cleans up.
+                job.status = CANCELLED
+                if job.process is not None:
+                    job.process.terminate()
+            else:
+                del self.jobs[job_id]
+                self._remove_checkpoint(job)
+            return job
+
+    def stop(self, job_id):
+        """Let a running job finish now with its best solution so far, cancel a queued one. Returns the job or None."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status == QUEUED:
+                job.future.cancel()
+                self._finish(job, CANCELLED)
+            elif job.status == RUNNING:
+                job.stop_requested.set()
+            return job
+
+    def events(self, job_id, heartbeat=15):
+        """
+        Yield ``('progress', report)`` for every iteration of the job, starting with the latest report so
+        far, and a final ``(status, job)`` once it has finished. A subscriber that falls more than
+        ``PROGRESS_HISTORY`` reports behind skips the oldest ones. Yields None when nothing happened for
+        ``heartbeat`` seconds.
+        """
+        sent = None
+        while True:
+            with self.changed:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return
+                if sent is None:
+                    sent = max(job.reports - 1, 0)
+                self.changed.wait_for(lambda: job.reports > sent or job.status in FINISHED, timeout=heartbeat)
+                missed = min(job.reports - sent, len(job.progress))
+                reports = list(job.progress)[len(job.progress) - missed:]
+                sent = job.reports
+                finished = job.status in FINISHED
+            for report in reports:
+                yield PROGRESS, report
+            if finished:
+                yield job.status, job.to_dict()
+                return
+            if not reports:
+                yield None
+
+    def counts(self):
+        """Number of known jobs per status."""
+        with self.lock:
+            counts = dict.fromkeys((QUEUED, RUNNING) + FINISHED, 0)
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def shutdown(self):
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.status not in FINISHED]
+        for job in jobs:
+            self.delete(job.id)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _run(self, job):
+        with self.lock:
+            if job.status != QUEUED:
+                return
+            job.status = RUNNING
+            job.started = time()
+            job.stop_requested = multiprocessing.Event()
+
+        try:
+            instance = None if self.instances is None else self.instances.load(job.input_file_path)
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                if job.status == RUNNING:
+                    job.error = str(e)
+                    self._finish(job, FAILED)
+                else:
+                    self._finish(job, job.status)
+            return
+
+        results = multiprocessing.Queue()
+        with self.lock:
+            if job.status != RUNNING:
+                self._finish(job, job.status)
+                return
+            job.process = multiprocessing.Process(target=_optimize,
+                                                  args=(job.input_file_path, job.output_file_path, job.timeout,
+                                                        job.workers, results, job.stop_requested, instance,
+                                                        job.checkpoint_path, self.checkpoint_interval,
+                                                        job.resume_path))
+            job.process.start()
+            if self.metrics is not None:
+                job.tracker = self.metrics.track('job')
+
+        outcome = (FAILED, "The optimization process exited without a result")
+        while True:
+            try:
+                message = results.get(timeout=1)
+            except queue.Empty:
+                if not job.process.is_alive() and results.empty():
+                    break
+                continue
+            if message[0] == PROGRESS:
+                if job.tracker is not None:
+                    job.tracker.report(message[1])
+                with self.changed:
+                    job.progress.append(message[1])
+                    job.reports += 1
+                    self.changed.notify_all()
+            else:
+                outcome = message
+                break
+        job.process.join()
+
+        with self.lock:
+            if job.status == RUNNING:
+                status, value = outcome
+                if status == DONE:
+                    job.result = value
+                else:
+                    job.error = value
+                self._finish(job, status)
+            else:
+                self._finish(job, job.status)
+
+    def _finish(self, job, status):
+        # Called with the lock held.
+        job.status = status
+        job.finished = time()
+        job.process = None
+        if job.tracker is not None:
+            job.tracker.finish(status)
+        shutil.rmtree(job.directory, ignore_errors=True)
+        self._prune_checkpoints()
+        self.changed.notify_all()
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            self._remove_checkpoint(self.jobs.pop(job_id))
+
+    def _prune_checkpoints(self):
+        # Called with the lock held (or before any job exists). Checkpoints of unfinished jobs are kept.
+        if self.checkpoint_directory is None:
+            return
+        active = {job.id + '.checkpoint' for job in self.jobs.values() if job.status not in FINISHED}
+        checkpoints = []
+        for entry in os.scandir(self.checkpoint_directory):
+            if entry.name.endswith('.checkpoint') and entry.name not in active:
+                try:
+                    checkpoints.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+        checkpoints.sort(reverse=True)
+        for _, path in checkpoints[max(0, self.max_checkpoints - len(active)):]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _remove_checkpoint(job):
+        if job.checkpoint_path is not None and os.path.exists(job.checkpoint_path):
+            os.remove(job.checkpoint_path)
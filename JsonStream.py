@@ -0,0 +1,104 @@
+"""Incremental reading of large JSON documents.
+
+``iter_object`` walks the members of a top-level JSON object while reading
+the file in chunks. Members whose key is in ``stream_keys`` must hold an
+array; instead of the decoded array they are returned as an iterator over
+its elements, so a huge array (the ``cars`` of a metropolitan instance) is
+never held in memory as a whole. All other members are decoded with the
+standard ``json`` module.
+"""
+import json
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+# Characters that can continue a number the decoder has only seen part of.
+_number_continuations = '0123456789+-.eE'
+
+
+class _Reader:
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(self.chunk_size):
+                return ''
+
+    def expect(self, characters):
+        c = self.peek()
+        if c == '' or c not in characters:
+            raise ValueError(f"Expected one of {characters!r} at offset {self.pos}, found {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Incomplete value, read at least as much again as is buffered so long values stay linear.
+                if not self._fill(max(self.chunk_size, len(self.buffer) - self.pos)):
+                    raise
+                continue
+            if (end == len(self.buffer) or self.buffer[end] in _number_continuations) and not self.eof \
+                    and self._fill(self.chunk_size):
+                # A number cut at the end of the buffer continues in the next chunk, decode again with more input.
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_array(reader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+def iter_object(f, stream_keys=(), chunk_size=1 << 20):
+    """
+    Yield ``(key, value)`` for every member of the JSON object in the text file ``f``.
+
+    For keys in ``stream_keys`` the value is an iterator over the array elements. Members after it
+    are read once the iterator is exhausted, which happens automatically if the caller moves on
+    without exhausting it.
+    """
+    reader = _Reader(f, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key in stream_keys:
+            elements = _iter_array(reader)
+            yield key, elements
+            for _ in elements:
+                pass
+        else:
+            yield key, reader.value()
+        if reader.expect(',}') == '}':
+            return
@@ -0,0 +1,244 @@
+"""Service metrics in the Prometheus text exposition format.
+
+A small registry of counters, gauges and histograms, rendered by the
+``/metrics`` endpoint of ``api.py``. Each metric has its own lock, and
+callback metrics read their value at scrape time without holding any
+metric lock, so a scrape never blocks the optimizer for long.
+
+``OptimizationMetrics`` holds the metrics of the optimization service.
+BeeHive runs feed it through ``track``: the returned ``RunTracker`` takes
+the progress reports of one run (``BeeHive(..., progress=tracker.report)``)
+and adds their evaluation, simulation and fitness cache counts to the
+totals. This also works for jobs, whose reports arrive from another
+process.
+"""
+import math
+import threading
+from time import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """
+        ``callback`` (optional) returns the value at scrape time instead of the stored ones, either a
+        number or ``{label values tuple: number}``.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """``(name, labels, value)`` of every sample, labels as ``((name, value), ...)``."""
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [(self.name, tuple(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only go up")
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per bucket counts, then the sum of the observations
+                counts = self.values[key] = [0] * len(self.buckets) + [0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        samples = []
+        for key, counts in sorted(values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + '_bucket', labels + (('le', _format_value(bound)),), count))
+            samples.append((self.name + '_sum', labels, counts[-1]))
+            samples.append((self.name + '_count', labels, counts[-2]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), callback=None):
+        return self._add(Counter(name, documentation, labelnames, callback))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._add(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+class RunTracker:
+    """Progress of one BeeHive run, see ``OptimizationMetrics.track``."""
+
+    def __init__(self, metrics, kind):
+        self.metrics = metrics
+        self.kind = kind
+        self.started = time()
+        self.last = {}
+        self.evaluations_per_second = 0.0
+        self.finished = False
+
+    def report(self, report):
+        """BeeHive progress callback, adds what happened since the previous report to the totals."""
+        metrics = self.metrics
+        for key, counter in (("evaluations", metrics.evaluations), ("simulations", metrics.simulations),
+                             ("fitness_cache_hits", metrics.fitness_cache_hits),
+                             ("fitness_cache_misses", metrics.fitness_cache_misses)):
+            value = report.get(key)
+            if value is None:
+                continue
+            delta = value - self.last.get(key, 0)
+            if delta > 0:
+                counter.inc(delta)
+            self.last[key] = value
+        self.evaluations_per_second = report.get("evaluations_per_second", 0.0)
+        return False
+
+    def finish(self, status):
+        if self.finished:
+            return
+        self.finished = True
+        self.metrics.active.dec(kind=self.kind)
+        self.metrics.durations.observe(time() - self.started, kind=self.kind, status=status)
+        with self.metrics.lock:
+            self.metrics.runs.discard(self)
+
+
+class OptimizationMetrics:
+    def __init__(self, registry=None):
+        self.registry = Registry() if registry is None else registry
+        self.lock = threading.Lock()
+        self.runs = set()
+        registry = self.registry
+        self.requests = registry.counter('traffic_http_requests_total', 'HTTP requests handled.',
+                                         ('method', 'endpoint', 'status'))
+        self.durations = registry.histogram('traffic_optimization_duration_seconds',
+                                            'Wall time of finished optimizations.', ('kind', 'status'))
+        self.active = registry.gauge('traffic_optimizations_active', 'Optimizations running now.', ('kind',))
+        self.evaluations = registry.counter('traffic_evaluations_total', 'Candidate schedules evaluated by BeeHive.')
+        self.simulations = registry.counter('traffic_simulations_total',
+                                            'Traffic simulations run, evaluations not answered by the fitness cache.')
+        self.fitness_cache_hits = registry.counter('traffic_fitness_cache_hits_total', 'Fitness cache hits.')
+        self.fitness_cache_misses = registry.counter('traffic_fitness_cache_misses_total', 'Fitness cache misses.')
+        registry.gauge('traffic_evaluations_per_second',
+                       'Evaluation throughput of the running optimizations, summed over them.',
+                       callback=self._evaluations_per_second)
+
+    def track(self, kind):
+        """Start tracking a run of ``kind`` ('generate' or 'job'), call ``finish`` on the tracker at its end."""
+        tracker = RunTracker(self, kind)
+        self.active.inc(kind=kind)
+        with self.lock:
+            self.runs.add(tracker)
+        return tracker
+
+    def watch(self, instances=None, jobs=None):
+        """Expose the state of an ``InstanceRegistry`` and a ``JobManager``, read at scrape time."""
+        registry = self.registry
+        if instances is not None:
+            for key, name, documentation in (
+                    ("hits", 'traffic_instance_cache_hits_total', 'Parsed instances served from memory.'),
+                    ("snapshot_hits", 'traffic_instance_cache_snapshot_hits_total',
+                     'Parsed instances loaded from a snapshot.'),
+                    ("misses", 'traffic_instance_cache_misses_total', 'Instances parsed from JSON.')):
+                registry.counter(name, documentation, callback=lambda key=key: instances.stats()[key])
+            registry.gauge('traffic_instance_cache_size', 'Parsed instances held in memory.',
+                           callback=lambda: instances.stats()["size"])
+        if jobs is not None:
+            registry.gauge('traffic_jobs', 'Known jobs by status.', ('status',),
+                           callback=lambda: {(status,): count for status, count in jobs.counts().items()})
+
+    def _evaluations_per_second(self):
+        with self.lock:
+            return sum(run.evaluations_per_second for run in self.runs)
@@ -0,0 +1,94 @@
+"""Process-pool evaluation of batches of candidate schedules.
+
+Every worker receives the parsed instance once, through the pool
+initializer, and afterwards only schedules travel between processes.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import GlobalFunctions as gl
+import IncrementalEvaluation as ie
+
+_instance = None
+_engine = 'python'
+_incremental = False
+_cohorts = False
+_traces = OrderedDict()
+_max_traces = 8
+
+
+def _init_worker(instance, engine, incremental, cohorts):
+    global _instance, _engine, _incremental, _cohorts
+    _instance = instance
+    _engine = engine
+    _incremental = incremental
+    _cohorts = cohorts
+    _traces.clear()
+
+
+def _trace(parent):
+    # Parents are few and recruited from many times, keep their traces per worker.
+    key = gl.schedule_fingerprint(parent)
+    trace = _traces.get(key)
+    if trace is None:
+        trace = ie.trace_schedule(parent, *_instance)
+        _traces[key] = trace
+        if len(_traces) > _max_traces:
+            _traces.popitem(last=False)
+    else:
+        _traces.move_to_end(key)
+    return trace
+
+
+def _grade(task):
+    """Grade one chunk ``(schedules, parents, cutoffs, fidelity)`` of a batch."""
+    schedules, parents, cutoffs, fidelity = task
+    results = [None] * len(schedules)
+    simulated = []
+    for index, parent in enumerate(parents):
+        if _incremental and parent is not None and gl.is_full_fidelity(fidelity):
+            results[index] = ie.grade_incremental(_trace(parent), schedules[index])
+        else:
+            simulated.append(index)
+    if simulated:
+        # the rest of the chunk is simulated back to back, sharing the setup of the instance
+        graded = gl.grade_many([schedules[index] for index in simulated], *_instance, engine=_engine,
+                               cohorts=_cohorts, cutoffs=[cutoffs[index] for index in simulated],
+                               fidelity=fidelity)
+        for index, result in zip(simulated, graded):
+            results[index] = result
+    return results
+
+
+class ParallelEvaluator:
+    """Grades batches of schedules in a ``concurrent.futures`` process pool.
+
+    ``instance`` is the tuple ``(streets, intersections, paths, total_duration,
+    bonus_points, yellow_phase, duration_to_pass_through_a_traffic_light)``.
+    """
+
+    def __init__(self, workers, instance, engine='python', incremental=False, cohorts=False):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(instance, engine, incremental, cohorts))
+
+    def grade_many(self, schedules, parents=None, cutoffs=None, fidelity='full'):
+        """Grade ``schedules`` and return their ``(score, cars, avg)`` tuples in order.
+
+        ``parents`` optionally holds, per schedule, the schedule it was derived
+        from, used by workers for incremental evaluation. ``cutoffs``
+        optionally holds the ``gl.grade`` cutoff of every schedule. Below full
+        ``fidelity`` the schedules are graded from scratch, incremental
+        evaluation only reproduces full simulations.
+        """
+        if parents is None:
+            parents = [None] * len(schedules)
+        if cutoffs is None:
+            cutoffs = [None] * len(schedules)
+        chunksize = max(1, len(schedules) // (4 * self.workers))
+        chunks = [(schedules[start:start + chunksize], parents[start:start + chunksize],
+                   cutoffs[start:start + chunksize], fidelity) for start in range(0, len(schedules), chunksize)]
+        return [result for results in self.executor.map(_grade, chunks) for result in results]
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
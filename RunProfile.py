@@ -0,0 +1,62 @@
+"""Counters and timers of an optimization run.
+
+``BeeHive`` fills a ``RunProfile`` while it searches: where the time goes
+(grading, the mutation operators, copying schedules, generating scouts,
+sorting patches) and how much work was done (evaluations, moves and
+improvements per operator, iterations). ``to_dict`` is returned with the
+solution JSON.
+
+Timers are plain ``perf_counter`` differences summed per name, cheap
+enough for the hot loop: timing one call costs well under a microsecond,
+grading a schedule costs milliseconds.
+"""
+from time import perf_counter
+
+
+class _Timer:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add_time(self.name, perf_counter() - self.start)
+        return False
+
+
+class RunProfile:
+    def __init__(self):
+        self.started = perf_counter()
+        # name -> [calls, seconds]
+        self.timers = {}
+        self.counters = {}
+
+    def timer(self, name):
+        """Context manager adding the time spent in its block to the timer ``name``."""
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [calls, seconds]
+        else:
+            timer[0] += calls
+            timer[1] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        wall_time = perf_counter() - self.started
+        return {
+            "wall_time": wall_time,
+            "timers": {name: {"calls": calls, "seconds": seconds,
+                              "share": seconds / wall_time if wall_time > 0 else 0.0}
+                       for name, (calls, seconds) in sorted(self.timers.items(), key=lambda item: -item[1][1])},
+            "counters": dict(sorted(self.counters.items())),
+        }
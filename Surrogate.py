@@ -0,0 +1,172 @@
+"""Surrogate pre-screening of candidate schedules.
+
+A full simulation per candidate is what limits ``BeeHive``. ``DelaySurrogate``
+estimates the score of a schedule in microseconds from a queueing model of
+every phase, so that a pool of candidate moves can be ranked and only the
+most promising ones simulated with ``gl.grade``.
+
+For every phase the model looks at the cars released by its signal group:
+the cars queued there at the start (``initial``), the cars arriving later
+(``arrivals``), the effective green seconds ``G`` (green time minus yellow,
+times the usage factor, as in the simulation), the cycle length ``C`` and the
+offset of the phase in the cycle. Summed over all phases this gives three
+features:
+
+* the waiting of the initial queues: the first green comes after the offset,
+  then ``G`` cars leave per cycle, each car waiting at most the horizon;
+* the uniform delay of later arrivals, ``(C - G)^2 / 2C`` per car (Webster);
+* the cars beyond the capacity ``G * total_duration / C`` of the phase.
+
+The score is modelled as a linear function of the features, fitted by least
+squares to the simulation results collected during the run. Predictions made
+before their schedule was simulated are kept to report the accuracy of the
+surrogate (``stats``).
+"""
+import numpy as np
+
+import GlobalFunctions as gl
+
+
+class DelaySurrogate:
+    """
+    Linear queueing-delay model of the score, calibrated online.
+
+    ``ready`` becomes True once ``min_samples`` simulation results have been observed. Only the last
+    ``max_samples`` results are used for the fit.
+    """
+
+    def __init__(self, streets, intersections, paths, total_duration, yellow_phase,
+                 duration_to_pass_through_a_traffic_light, min_samples=30, max_samples=2000):
+        self.intersections = intersections
+        self.total_duration = total_duration
+        self.yellow_phase = yellow_phase
+        self.usage_factor = 1 / duration_to_pass_through_a_traffic_light
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+
+        car_paths = gl.CarPaths.from_paths(streets, paths)
+        street_ids = car_paths.street_ids
+        offsets = car_paths.offsets
+        initial = [0] * len(streets)
+        arrivals = [0] * len(streets)
+        for car in range(len(car_paths)):
+            initial[street_ids[offsets[car]]] += 1
+            # the last street of a path ends where the car finishes, it crosses no light there
+            for hop in range(offsets[car] + 1, offsets[car + 1] - 1):
+                arrivals[street_ids[hop]] += 1
+        self.initial = initial
+        self.arrivals = arrivals
+        self._demand = {}
+
+        self.features = []
+        self.scores = []
+        self.coefficients = None
+        self.mean = None
+        self.scale = None
+        self.dirty = False
+        # (predicted, simulated) of schedules predicted before they were simulated
+        self.predictions = []
+        self.screened = 0
+        self.kept = 0
+
+    @property
+    def ready(self):
+        return len(self.scores) >= self.min_samples
+
+    def _group_demand(self, i_intersection, street_id):
+        key = (i_intersection, street_id)
+        demand = self._demand.get(key)
+        if demand is None:
+            group = self.intersections[i_intersection].signal_groups.get(street_id, (street_id,))
+            demand = (sum(self.initial[s] for s in group), sum(self.arrivals[s] for s in group))
+            self._demand[key] = demand
+        return demand
+
+    def schedule_features(self, schedules):
+        """Feature vector ``[initial queue waiting, arrival delay, unserved cars]`` of a schedule."""
+        total_duration = self.total_duration
+        yellow_phase = self.yellow_phase
+        usage_factor = self.usage_factor
+        queue_waiting = 0.0
+        arrival_delay = 0.0
+        unserved = 0.0
+        for schedule in schedules:
+            intersection = self.intersections[schedule.i_intersection]
+            order = list(schedule.order)
+            green_times = [schedule.green_times[street_id] for street_id in order]
+            cycle = sum(green_times)
+            if len(order) > 1:
+                cycle += intersection.pedestrian_phase_interval + intersection.all_red_phase_interval
+            offset = 0
+            for street_id, green_time in zip(order, green_times):
+                initial, arrivals = self._group_demand(schedule.i_intersection, street_id)
+                effective_green = int(usage_factor * (green_time - yellow_phase)) if len(order) > 1 else cycle
+                if effective_green <= 0:
+                    unserved += initial + arrivals
+                else:
+                    capacity = effective_green * total_duration / cycle
+                    unserved += max(0.0, initial + arrivals - capacity)
+                    queue_waiting += initial * min(total_duration, offset + initial * cycle / (2 * effective_green))
+                    arrival_delay += arrivals * (cycle - effective_green) ** 2 / (2 * cycle)
+                offset += green_time
+        return [queue_waiting, arrival_delay, unserved]
+
+    def observe(self, features, score, predicted=None):
+        """Add the simulated ``score`` of a schedule with ``features``, ``predicted`` by the surrogate before."""
+        self.features.append(features)
+        self.scores.append(score)
+        if len(self.scores) > self.max_samples:
+            del self.features[0]
+            del self.scores[0]
+        if predicted is not None:
+            self.predictions.append((predicted, score))
+        self.dirty = True
+
+    def _fit(self):
+        x = np.array(self.features, dtype=float)
+        y = np.array(self.scores, dtype=float)
+        self.mean = x.mean(axis=0)
+        self.scale = x.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        design = np.hstack([np.ones((len(y), 1)), (x - self.mean) / self.scale])
+        # a little ridge keeps the fit stable while the samples hardly vary
+        ridge = 1e-6 * len(y) * np.eye(design.shape[1])
+        ridge[0, 0] = 0.0
+        self.coefficients = np.linalg.solve(design.T @ design + ridge, design.T @ y)
+        self.dirty = False
+
+    def predict(self, features):
+        """Predicted scores for a list of feature vectors."""
+        if self.dirty or self.coefficients is None:
+            self._fit()
+        x = (np.array(features, dtype=float) - self.mean) / self.scale
+        return (self.coefficients[0] + x @ self.coefficients[1:]).tolist()
+
+    def screen(self, schedules, keep):
+        """
+        Indices of the ``keep`` schedules with the best predicted score, with their features and predictions.
+
+        Returns ``[(index, features, predicted), ...]`` best first.
+        """
+        features = [self.schedule_features(schedule) for schedule in schedules]
+        predicted = self.predict(features)
+        best = sorted(range(len(schedules)), key=lambda index: predicted[index], reverse=True)[:keep]
+        self.screened += len(schedules)
+        self.kept += len(best)
+        return [(index, features[index], predicted[index]) for index in best]
+
+    def stats(self):
+        """Accuracy of the predictions made before simulating, and the screening counts."""
+        stats = {"samples": len(self.scores), "screened": self.screened, "kept": self.kept,
+                 "predictions": len(self.predictions), "mean_absolute_error": None,
+                 "mean_relative_error": None, "rank_correlation": None}
+        if self.predictions:
+            predicted, simulated = (np.array(values, dtype=float) for values in zip(*self.predictions))
+            errors = np.abs(predicted - simulated)
+            stats["mean_absolute_error"] = float(errors.mean())
+            stats["mean_relative_error"] = float((errors / np.maximum(np.abs(simulated), 1)).mean())
+            if len(predicted) > 2 and predicted.std() > 0 and simulated.std() > 0:
+                # Spearman: the correlation of the ranks
+                ranks = [values.argsort().argsort() for values in (predicted, simulated)]
+                stats["rank_correlation"] = float(np.corrcoef(*ranks)[0, 1])
+        return stats
@@ -1,12 +1,54 @@
+import logging
 import os
+import shutil
 import subprocess
+import tempfile
 import time
-from flask import Flask, json, jsonify, request, send_file
+from flask import Flask, Response, json, jsonify, request, send_file
 from BeeHiveOptimization import BeeHive
 import GlobalFunctions as gl
+from InstanceRegistry import InstanceRegistry
+from JobManager import JobManager
+from Metrics import CONTENT_TYPE, OptimizationMetrics
 import traceback 
 
+# BeeHive logs its search at DEBUG and a run profile at INFO, set LOG_LEVEL to see them.
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING').upper())
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
+# Snapshots on disk only with INSTANCE_CACHE_DIR, a private directory (see InstanceRegistry.private_directory).
+instances = InstanceRegistry(max_size=int(os.environ.get('INSTANCE_CACHE_SIZE', 8)),
+                             directory=os.environ.get('INSTANCE_CACHE_DIR'))
+metrics = OptimizationMetrics()
+# Jobs only checkpoint with CHECKPOINT_DIR, a private directory like INSTANCE_CACHE_DIR.
+jobs = JobManager(max_jobs=int(os.environ.get('MAX_JOBS', 2)), instances=instances, metrics=metrics,
+                  checkpoint_directory=os.environ.get('CHECKPOINT_DIR'),
+                  checkpoint_interval=int(os.environ.get('CHECKPOINT_INTERVAL', 60)),
+                  max_checkpoints=int(os.environ.get('MAX_CHECKPOINTS', 100)))
+metrics.watch(instances=instances, jobs=jobs)
+# Upper bound of the 'workers' form field, larger requests are clamped to it.
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', os.cpu_count() or 1))
+
+
+def requested_workers():
+    # The 'workers' form field clamped to MAX_WORKERS, None if it is not a count of processes.
+    try:
+        workers = int(request.form.get('workers', 0))
+    except ValueError:
+        return None
+    if workers < 0:
+        return None
+    return min(workers, MAX_WORKERS)
+
+
+@app.after_request
+def count_request(response):
+    # Route templates, not paths, keep the job ids out of the labels.
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.requests.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    return response
+
 
 @app.route('/')
 def home():
@@ -23,11 +65,17 @@ def generate():
         return jsonify({"error": "No selected file"}), 400
 
     timeout = int(request.form.get('timeout', 10))
+    workers = requested_workers()
+    if workers is None:
+        return jsonify({"error": "workers must be a non-negative integer"}), 400
     
+    # Every request gets its own directory, concurrent requests must not share an input file
+    directory = tempfile.mkdtemp(prefix='generate-')
+    tracker = metrics.track('generate')
+    status = 'failed'
     try:
         # Save the uploaded file to a temporary location
-        input_filename = 'input.json'
-        output_filename = 'output.json'
+        input_filename = os.path.join(directory, 'input.json')
         file.save(input_filename)
 
         output_file_path = os.path.abspath('output/output.json')
@@ -36,30 +84,33 @@ def generate():
         total_duration, bonus_points, intersections, streets, name_to_i_street, paths, \
             duration_to_pass_through_a_traffic_light, yellow_phase, limit_on_minimum_cycle_length, \
             limit_on_maximum_cycle_length, limit_on_minimum_green_phase_duration, \
-            limit_on_maximum_green_phase_duration, i_id_to_intersection = gl.readInput(input_filename)
+            limit_on_maximum_green_phase_duration, i_id_to_intersection = instances.load(input_filename)
         
-        print(limit_on_minimum_cycle_length)
+        logger.debug("Minimum cycle length: %s", limit_on_minimum_cycle_length)
 
         if timeout:
             use_seed = output_file_path
-            solution_file_path = './seeds/' + input_filename + '.txt.out'
-            print("kendej")
+            solution_file_path = './seeds/' + os.path.basename(input_filename) + '.txt.out'
             schedule, score, cars, avg , resultJSON = BeeHive(streets, intersections, paths, total_duration, bonus_points, start,
                                                 yellow_phase, name_to_i_street, limit_on_minimum_green_phase_duration,
                                                 limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length,
                                                 limit_on_maximum_cycle_length, duration_to_pass_through_a_traffic_light,
-                                                i_id_to_intersection, output_file_path, use_seed, solution_file_path, timeout)
+                                                i_id_to_intersection, output_file_path, use_seed, solution_file_path, timeout,
+                                                workers=workers, progress=tracker.report)
             
-            print(resultJSON)
+            logger.debug("Solution: %s", resultJSON)
+            status = 'done'
             return resultJSON
         else:
             schedule, score, cars, avg, resultJSON = BeeHive(streets, intersections, paths, total_duration, bonus_points, start,
                                                 yellow_phase, name_to_i_street, limit_on_minimum_green_phase_duration,
                                                 limit_on_maximum_green_phase_duration, limit_on_minimum_cycle_length,
                                                 limit_on_maximum_cycle_length, duration_to_pass_through_a_traffic_light,
-                                                i_id_to_intersection, output_file_path, 10)
+                                                i_id_to_intersection, output_file_path, 10, workers=workers,
+                                                progress=tracker.report)
             
-            print(resultJSON)
+            logger.debug("Solution: %s", resultJSON)
+            status = 'done'
             return resultJSON
             
 
@@ -69,10 +120,78 @@ def generate():
 
     finally:
         # Clean up the temporary files
-        if os.path.exists(input_filename):
-            os.remove(input_filename)
-        if os.path.exists(output_filename):
-            os.remove(output_filename)
+        shutil.rmtree(directory, ignore_errors=True)
+        tracker.finish(status)
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    if 'file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+
+    file = request.files['file']
+
+    if file.filename == '':
+        return jsonify({"error": "No selected file"}), 400
+
+    timeout = int(request.form.get('timeout', 10))
+    workers = requested_workers()
+    if workers is None:
+        return jsonify({"error": "workers must be a non-negative integer"}), 400
+    # id of an earlier job, also from before a restart, whose checkpointed population the new job continues
+    resume = request.form.get('resume') or None
+    if resume is not None and jobs.checkpoint_path(resume) is None:
+        return jsonify({"error": "Unknown checkpoint"}), 404
+
+    job = jobs.submit(file, timeout=timeout, workers=workers, resume=resume)
+    return jsonify(job.to_dict()), 202, {"Location": f"/jobs/{job.id}"}
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    job = jobs.delete(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/stop', methods=['POST'])
+def stop_job(job_id):
+    job = jobs.stop(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    if jobs.get(job_id) is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def stream():
+        # Server-sent events: one 'progress' event per BeeHive iteration, then the final job status.
+        for event in jobs.events(job_id):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                kind, data = event
+                yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(stream(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.render(), mimetype=None, content_type=CONTENT_TYPE)
+
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=80)
\ No newline at end of file
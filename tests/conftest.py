@@ -0,0 +1,60 @@
+import os
+import random
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import BeeHiveOptimization as bh  # noqa: E402
+import GlobalFunctions as gl  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def instance():
+    """The parsed ``input/input.json``, as returned by ``gl.readInput``."""
+    return gl.readInput(os.path.join(ROOT, 'input', 'input.json'))
+
+
+@pytest.fixture(scope='session')
+def grade_args(instance):
+    """
+    Build the positional ``gl.grade`` arguments after the schedules for the instance.
+
+    Keyword arguments replace the duration, the bonus, the yellow phase or the pass-through duration of the instance.
+    """
+    (duration, bonus, intersections, streets, _, paths, duration_to_pass_default, yellow_phase_default,
+     *_) = instance
+
+    def build(total_duration=None, bonus_points=None, yellow_phase=None, duration_to_pass=None):
+        return (streets, intersections, paths,
+                duration if total_duration is None else total_duration,
+                bonus if bonus_points is None else bonus_points,
+                yellow_phase_default if yellow_phase is None else yellow_phase,
+                duration_to_pass_default if duration_to_pass is None else duration_to_pass)
+    return build
+
+
+@pytest.fixture(scope='session')
+def schedules(instance):
+    """Seeded random schedules for the instance, each one a neighbour of the one before."""
+    (total_duration, bonus_points, intersections, streets, name_to_i_street, paths, duration_to_pass, yellow_phase,
+     min_cycle, max_cycle, min_green, max_green, i_id_to_intersection) = instance
+    random.seed(3)
+    solutions = [gl.ScheduleArray.from_schedules(bh.generateSolution(intersections, name_to_i_street, min_green,
+                                                                     max_green, min_cycle, max_cycle))]
+    for _ in range(7):
+        solution = bh.copyScheduleArray(solutions[-1])
+        solution = bh.shuffleOrder(solution, 1, intersections, name_to_i_street)
+        solution = bh.changeGreenTimeDuration(solution, 1, 1, min_green, max_green, min_cycle, max_cycle,
+                                              i_id_to_intersection)
+        solutions.append(solution)
+    return solutions
+
+
+@pytest.fixture(scope='session')
+def expected(grade_args, schedules):
+    """The results of the Python engine for ``schedules``, the reference of every faster path."""
+    args = grade_args()
+    return [gl.grade(schedule, *args) for schedule in schedules]
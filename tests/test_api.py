@@ -0,0 +1,32 @@
+"""The 'workers' form field of /generate and /jobs is validated and clamped before anything runs."""
+import io
+
+import pytest
+
+import api
+
+
+@pytest.fixture
+def client():
+    return api.app.test_client()
+
+
+def _upload(**fields):
+    return dict(fields, file=(io.BytesIO(b'{}'), 'input.json'))
+
+
+@pytest.mark.parametrize('route', ['/generate', '/jobs'])
+@pytest.mark.parametrize('workers', ['many', '1.5', '-1'])
+def test_invalid_workers(client, route, workers):
+    response = client.post(route, data=_upload(workers=workers), content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert 'workers' in response.get_json()['error']
+
+
+def test_workers_are_clamped():
+    with api.app.test_request_context('/jobs', method='POST', data={'workers': str(10 ** 6)}):
+        assert api.requested_workers() == api.MAX_WORKERS
+    with api.app.test_request_context('/jobs', method='POST', data={'workers': '1'}):
+        assert api.requested_workers() == min(1, api.MAX_WORKERS)
+    with api.app.test_request_context('/jobs', method='POST'):
+        assert api.requested_workers() == 0
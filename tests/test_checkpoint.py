@@ -0,0 +1,85 @@
+"""Checkpoints give back the population they saved, and only for the instance they were written for."""
+import random
+from array import array
+from types import SimpleNamespace
+
+import pytest
+
+import Checkpoint
+import GlobalFunctions as gl
+
+
+def _patches(schedules, expected):
+    return [SimpleNamespace(score=score, scout=schedule, cars=cars, avg=avg, stgLim=k)
+            for k, (schedule, (score, cars, avg)) in enumerate(zip(schedules, expected))]
+
+
+def _unpacked(schedule):
+    return (list(schedule.i_intersections), list(schedule.offsets), sorted(schedule.slots.items()),
+            list(schedule.orders), list(schedule.green_times))
+
+
+def test_round_trip(tmp_path, grade_args, schedules, expected):
+    path = str(tmp_path / 'run.checkpoint')
+    signature = Checkpoint.instance_signature(*grade_args())
+    patches = _patches(schedules, expected)
+    random.seed(5)
+    state = random.getstate()
+    Checkpoint.save(path, signature, patches, 0.25, 12, 345, state)
+
+    checkpoint = Checkpoint.load(path, signature)
+    assert [(score, _unpacked(scout), cars, avg, stg) for score, scout, cars, avg, stg in checkpoint["patches"]] == \
+        [(p.score, _unpacked(p.scout), p.cars, p.avg, p.stgLim) for p in patches]
+    assert (checkpoint["shrinkage_factor"], checkpoint["iterations"], checkpoint["evaluations"]) == (0.25, 12, 345)
+    assert checkpoint["random_state"] == state
+    # one layout, shared by the loaded patches as by the copies of one ScheduleArray
+    assert len({id(scout.offsets) for _, scout, *_ in checkpoint["patches"]}) == 1
+
+
+def test_layout_per_patch(tmp_path, grade_args, schedules, expected):
+    path = str(tmp_path / 'run.checkpoint')
+    signature = Checkpoint.instance_signature(*grade_args())
+    street_id = schedules[0].orders[0]
+    other = type(schedules[0])(array('i', [schedules[0].i_intersections[0]]), array('i', [0, 1]), {street_id: 0},
+                               array('i', [street_id]), array('i', [3]))
+    patches = _patches([schedules[0], other, schedules[1]], expected)
+    Checkpoint.save(path, signature, patches, 1.0, 0, 0, random.getstate())
+
+    loaded = [_unpacked(scout) for _, scout, *_ in Checkpoint.load(path, signature)["patches"]]
+    assert loaded == [_unpacked(p.scout) for p in patches]
+
+
+def test_signature_covers_the_instance(grade_args):
+    streets, intersections, paths, *rest = grade_args()
+    signature = Checkpoint.instance_signature(*grade_args())
+    assert Checkpoint.instance_signature(*grade_args()) == signature
+    assert Checkpoint.instance_signature(*grade_args(bonus_points=rest[1] + 1)) != signature
+    assert Checkpoint.instance_signature(*grade_args(yellow_phase=rest[2] + 1)) != signature
+    fewer_cars = gl.CarPaths(streets)
+    for car in range(len(paths) - 1):
+        fewer_cars.append(paths.street_ids[paths.offsets[car]:paths.offsets[car + 1]])
+    assert Checkpoint.instance_signature(streets, intersections, fewer_cars, *rest) != signature
+    street = streets[0]
+    street.duration += 1
+    try:
+        assert Checkpoint.instance_signature(*grade_args()) != signature
+    finally:
+        street.duration -= 1
+
+
+def test_other_instance_is_refused(tmp_path, grade_args, schedules, expected):
+    path = str(tmp_path / 'run.checkpoint')
+    Checkpoint.save(path, Checkpoint.instance_signature(*grade_args()), _patches(schedules, expected), 1.0, 0, 0,
+                    random.getstate())
+    with pytest.raises(ValueError, match='another instance'):
+        Checkpoint.load(path, Checkpoint.instance_signature(*grade_args(total_duration=60)))
+
+
+def test_damaged_checkpoint_is_refused(tmp_path, grade_args):
+    path = tmp_path / 'run.checkpoint'
+    path.write_text('{"version": 3, "signature": "x"')
+    with pytest.raises(ValueError, match='not valid JSON'):
+        Checkpoint.load(str(path), 'x')
+    path.write_text('{"version": 3, "signature": "x", "byteorder": "little", "layouts": []}')
+    with pytest.raises(ValueError, match='damaged'):
+        Checkpoint.load(str(path), 'x')
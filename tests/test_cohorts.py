@@ -0,0 +1,28 @@
+"""Cohort mode must not change the result of the Python engine."""
+import pytest
+
+import GlobalFunctions as gl
+
+
+def test_cohorts(grade_args, schedules, expected):
+    args = grade_args()
+    assert [gl.grade(schedule, *args, cohorts=True) for schedule in schedules] == expected
+
+
+@pytest.mark.parametrize('total_duration', [60, 1500])
+def test_cohorts_on_other_horizons(grade_args, schedules, total_duration):
+    args = grade_args(total_duration)
+    assert gl.grade(schedules[3], *args, cohorts=True) == gl.grade(schedules[3], *args)
+
+
+def test_repeated_cars(grade_args, schedules):
+    # Every car three times in a row: the initial queues consist of real cohorts.
+    streets, intersections, paths, *rest = grade_args()
+    repeated = gl.CarPaths(streets)
+    for path in paths:
+        for _ in range(3):
+            repeated.append(street.id for street in path)
+    assert repeated.cohorts().num_cohorts < len(repeated)
+    args = (streets, intersections, repeated, *rest)
+    for schedule in schedules[:3]:
+        assert gl.grade(schedule, *args, cohorts=True) == gl.grade(schedule, *args)
@@ -0,0 +1,41 @@
+"""A cutoff may stop a simulation early, but never one that would beat it, and never with a wrong bound."""
+import pytest
+
+import GlobalFunctions as gl
+
+
+def _check(result, exact, cutoff):
+    if isinstance(result, gl.CutoffResult):
+        # stopped: the schedule cannot beat the cutoff and the score is a bound of its real score
+        assert exact[0] <= cutoff
+        assert exact[0] <= result[0] <= cutoff
+    else:
+        assert result == exact
+
+
+@pytest.mark.parametrize('cohorts', [False, True])
+def test_never_stops_a_better_schedule(grade_args, schedules, expected, cohorts):
+    args = grade_args()
+    for schedule, exact in zip(schedules, expected):
+        assert gl.grade(schedule, *args, cohorts=cohorts, cutoff=exact[0] - 1) == exact
+
+
+@pytest.mark.parametrize('cohorts', [False, True])
+@pytest.mark.parametrize('offset', [0, 1, 100, 10000])
+def test_bound_is_sound(grade_args, schedules, expected, cohorts, offset):
+    args = grade_args()
+    for schedule, exact in zip(schedules, expected):
+        _check(gl.grade(schedule, *args, cohorts=cohorts, cutoff=exact[0] + offset), exact, exact[0] + offset)
+
+
+def test_parent_score_as_cutoff(grade_args, schedules, expected):
+    # as BeeHive(early_abort=True) grades recruited bees
+    args = grade_args()
+    for k in range(1, len(schedules)):
+        _check(gl.grade(schedules[k], *args, cutoff=expected[k - 1][0]), expected[k], expected[k - 1][0])
+
+
+def test_hopeless_cutoff_stops_at_once(grade_args, schedules):
+    result = gl.grade(schedules[0], *grade_args(), cutoff=10 ** 12)
+    assert isinstance(result, gl.CutoffResult)
+    assert result[1] == 0
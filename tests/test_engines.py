@@ -0,0 +1,22 @@
+"""The numpy and event engines must give exactly the results of the Python engine."""
+import pytest
+
+import GlobalFunctions as gl
+
+
+def test_schedules_differ(expected):
+    # The schedules must actually exercise the engines, not all score the same.
+    assert len(set(expected)) > 1
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'event'])
+def test_engines_agree(grade_args, schedules, expected, engine):
+    args = grade_args()
+    assert [gl.grade(schedule, *args, engine=engine) for schedule in schedules] == expected
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'event'])
+@pytest.mark.parametrize('total_duration, bonus_points', [(60, 7), (1500, 7)])
+def test_engines_agree_on_other_horizons(grade_args, schedules, engine, total_duration, bonus_points):
+    args = grade_args(total_duration, bonus_points)
+    assert gl.grade(schedules[3], *args, engine=engine) == gl.grade(schedules[3], *args)
@@ -0,0 +1,79 @@
+"""Grading below full fidelity: sampled cars scaled back, truncated horizons as lower bounds, exact promotions."""
+import json
+import random
+import time
+from collections import Counter
+
+import pytest
+
+import BeeHiveOptimization as bh
+import GlobalFunctions as gl
+
+
+def _path_counts(paths):
+    return Counter(paths.street_ids[paths.offsets[car]:paths.offsets[car + 1]].tobytes() for car in range(len(paths)))
+
+
+def test_levels():
+    assert gl.fidelity_level('medium') == gl.Fidelity(horizon=1.0, sample=0.5)
+    assert gl.fidelity_level(gl.Fidelity(horizon=0.3, sample=1.0)) == gl.Fidelity(horizon=0.3, sample=1.0)
+    assert gl.is_full_fidelity('full') and gl.is_full_fidelity(gl.Fidelity(horizon=1.0, sample=1.0))
+    assert not gl.is_full_fidelity('medium') and not gl.is_full_fidelity('low')
+    with pytest.raises(ValueError):
+        gl.fidelity_level('fast')
+
+
+def test_sample_is_stratified(grade_args):
+    streets, _, paths, *_ = grade_args()
+    sample = paths.sample(0.5)
+    assert sample is paths.sample(0.5)
+    full, sampled = _path_counts(paths), _path_counts(sample)
+    assert set(sampled) <= set(full)
+    # every stratum keeps half its cars, up to the rounding the strata pass on to each other
+    for path, count in full.items():
+        assert abs(sampled[path] - count / 2) <= 1
+    assert abs(len(sample) - len(paths) / 2) <= 1
+
+
+@pytest.mark.parametrize('cohorts', [False, True])
+def test_sample_is_scaled_back(grade_args, schedules, expected, cohorts):
+    streets, intersections, paths, *rest = grade_args()
+    sample = paths.sample(0.5)
+    scale = len(paths) / len(sample)
+    for schedule, exact in zip(schedules, expected):
+        score, cars, avg = gl.grade(schedule, streets, intersections, sample, *rest, cohorts=cohorts)
+        assert gl.grade(schedule, *grade_args(), cohorts=cohorts, fidelity='medium') == \
+            (round(score * scale), round(cars * scale), avg)
+        assert gl.grade(schedule, *grade_args(), cohorts=cohorts, fidelity=gl.Fidelity(horizon=1.0, sample=1.0)) == \
+            exact
+
+
+def test_truncated_horizon_is_a_lower_bound(grade_args, schedules, expected):
+    half = gl.Fidelity(horizon=0.5, sample=1.0)
+    for schedule, (score, cars, _) in zip(schedules, expected):
+        truncated = gl.grade(schedule, *grade_args(), fidelity=half)
+        assert truncated[0] <= score and truncated[1] <= cars
+        # the cars finished by then, each scoring as in the full simulation
+        total_duration = grade_args()[3]
+        horizon = int(total_duration * half.horizon)
+        short_score, short_cars, _ = gl.grade(schedule, *grade_args(total_duration=horizon))
+        assert truncated[:2] == (short_score + short_cars * (total_duration - horizon), short_cars)
+
+
+def test_other_engines_refuse_a_truncated_horizon(grade_args, schedules):
+    with pytest.raises(ValueError):
+        gl.grade(schedules[0], *grade_args(), engine='numpy', fidelity='low')
+
+
+def test_beehive_promotes_exactly(tmp_path, instance):
+    (total_duration, bonus_points, intersections, streets, name_to_i_street, paths, duration_to_pass, yellow_phase,
+     min_cycle, max_cycle, min_green, max_green, i_id_to_intersection) = instance
+    random.seed(11)
+    schedule, score, cars, avg, output = bh.BeeHive(
+        streets, intersections, paths, total_duration, bonus_points, time.time(), yellow_phase, name_to_i_street,
+        min_green, max_green, min_cycle, max_cycle, duration_to_pass, i_id_to_intersection,
+        str(tmp_path / 'output.json'), execution_time=3, fidelity='low')
+    # Recruits are screened at low fidelity, the promoted ones and the result are graded exactly.
+    assert 'promotions' in json.loads(output)['profile']['counters']
+    assert gl.grade(gl.ScheduleArray.from_schedules(schedule), streets, intersections, paths, total_duration,
+                    bonus_points, yellow_phase, duration_to_pass) == (score, cars, avg)
@@ -0,0 +1,48 @@
+"""``grade_many`` grades a batch like one ``grade`` call per candidate, building the per-car setup once."""
+import pytest
+
+import GlobalFunctions as gl
+
+
+@pytest.mark.parametrize('engine', ['python', 'numpy', 'event'])
+def test_grade_many(grade_args, schedules, expected, engine):
+    assert gl.grade_many(schedules, *grade_args(), engine=engine) == expected
+
+
+def test_grade_many_cohorts(grade_args, schedules, expected):
+    assert gl.grade_many(schedules, *grade_args(), cohorts=True) == expected
+
+
+def test_grade_many_cutoffs(grade_args, schedules, expected):
+    # Every candidate gets its own cutoff: the ones just below its score never stop it.
+    cutoffs = [score - 1 if k % 2 else score + 1 for k, (score, _, _) in enumerate(expected)]
+    results = gl.grade_many(schedules, *grade_args(), cutoffs=cutoffs)
+    for k, (result, cutoff) in enumerate(zip(results, cutoffs)):
+        if k % 2:
+            assert result == expected[k]
+        elif isinstance(result, gl.CutoffResult):
+            assert result[0] <= cutoff
+        else:
+            assert result == expected[k]
+
+
+def _fresh_paths(streets, paths):
+    copy = gl.CarPaths(streets)
+    for path in paths:
+        copy.append(street.id for street in path)
+    return copy
+
+
+def test_setup_is_shared(grade_args, schedules):
+    streets, intersections, paths, *rest = grade_args()
+    paths = _fresh_paths(streets, paths)
+    setup = paths.grade_setup()
+    gl.grade_many(schedules[:3], streets, intersections, paths, *rest)
+    assert paths.grade_setup() is setup
+
+
+def test_cohorts_need_no_setup(grade_args, schedules):
+    streets, intersections, paths, *rest = grade_args()
+    paths = _fresh_paths(streets, paths)
+    gl.grade_many(schedules[:3], streets, intersections, paths, *rest, cohorts=True)
+    assert paths._setup is None
@@ -0,0 +1,20 @@
+"""Incremental evaluation must grade a neighbour exactly like a full simulation."""
+import IncrementalEvaluation as ie
+
+
+def test_neighbours(grade_args, schedules, expected):
+    args = grade_args()
+    for k in range(1, len(schedules)):
+        trace = ie.trace_schedule(schedules[k - 1], *args)
+        assert ie.grade_incremental(trace, schedules[k]) == expected[k]
+
+
+def test_unchanged_schedule(grade_args, schedules, expected):
+    trace = ie.trace_schedule(schedules[2], *grade_args())
+    assert ie.grade_incremental(trace, schedules[2].copy()) == expected[2]
+
+
+def test_distant_schedule(grade_args, schedules, expected):
+    # Several moves away from the parent, the changes interact.
+    trace = ie.trace_schedule(schedules[0], *grade_args())
+    assert ie.grade_incremental(trace, schedules[-1]) == expected[-1]
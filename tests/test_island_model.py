@@ -0,0 +1,26 @@
+"""Island-model BeeHive: migration topologies and a short run of two islands."""
+import time
+
+import pytest
+
+import GlobalFunctions as gl
+import IslandModel
+
+
+def test_neighbours():
+    assert [IslandModel.neighbours(island, 3, 'ring') for island in range(3)] == [[1], [2], [0]]
+    assert [IslandModel.neighbours(island, 3, 'full') for island in range(3)] == [[1, 2], [0, 2], [0, 1]]
+    assert IslandModel.neighbours(0, 1, 'ring') == []
+    with pytest.raises(ValueError):
+        IslandModel.neighbours(0, 3, 'star')
+
+
+def test_islands_return_their_best(tmp_path, instance):
+    (total_duration, bonus_points, intersections, streets, name_to_i_street, paths, duration_to_pass, yellow_phase,
+     min_cycle, max_cycle, min_green, max_green, i_id_to_intersection) = instance
+    schedule, score, cars, avg, output = IslandModel.IslandBeeHive(
+        streets, intersections, paths, total_duration, bonus_points, time.time(), yellow_phase, name_to_i_street,
+        min_green, max_green, min_cycle, max_cycle, duration_to_pass, i_id_to_intersection,
+        str(tmp_path / 'output.json'), execution_time=2, islands=2, migration_interval=1, seed=1)
+    assert gl.grade(gl.ScheduleArray.from_schedules(schedule), streets, intersections, paths, total_duration,
+                    bonus_points, yellow_phase, duration_to_pass) == (score, cars, avg)
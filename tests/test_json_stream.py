@@ -0,0 +1,53 @@
+"""iter_object decodes a document the same at every chunk size, values cut by a chunk boundary included."""
+import io
+import json
+
+import pytest
+
+from JsonStream import iter_object
+
+DOCUMENT = {
+    "total_duration": 12345,
+    "bonus": -1.5e3,
+    "name": "café \"quoted\" \\ back\nslash",
+    "streets": [{"name": "rue-d'Arcole", "time": 10}, {"name": "a", "time": 1234567}],
+    "cars": [["a", "rue-d'Arcole"], [], ["a"] * 5],
+    "numbers": [0, 7, 123456789, -42, 3.25, 1e-7, 6.02e23, True, None],
+    "empty": {},
+    "last": 98765,
+}
+
+
+def _read(text, chunk_size, stream_keys=('cars', 'numbers')):
+    members = []
+    for key, value in iter_object(io.StringIO(text), stream_keys=stream_keys, chunk_size=chunk_size):
+        members.append((key, list(value) if key in stream_keys else value))
+    return dict(members)
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_every_chunk_size(indent):
+    text = json.dumps(DOCUMENT, indent=indent, ensure_ascii=False)
+    for chunk_size in range(1, len(text) + 2):
+        assert _read(text, chunk_size) == DOCUMENT, chunk_size
+
+
+def test_unread_streams_are_skipped():
+    # The caller moves on without reading 'cars', the members after it must still come.
+    text = json.dumps(DOCUMENT)
+    for chunk_size in (1, 3, 16, 1 << 20):
+        keys = [key for key, _ in iter_object(io.StringIO(text), stream_keys=('cars',), chunk_size=chunk_size)]
+        assert keys == list(DOCUMENT)
+
+
+@pytest.mark.parametrize('text', ['{}', ' { } ', '{"cars": []}', '{"cars": [ ]}'])
+def test_empty(text):
+    for chunk_size in (1, 2, 1 << 20):
+        assert _read(text, chunk_size) == json.loads(text)
+
+
+@pytest.mark.parametrize('text', ['', '[1]', '{"a": 1', '{"a" 1}', '{"cars": [1 2]}', '{"a": 12,'])
+def test_malformed(text):
+    for chunk_size in (1, 1 << 20):
+        with pytest.raises(ValueError):
+            _read(text, chunk_size)
@@ -0,0 +1,86 @@
+"""Compiled phase tables: the per-second layout, their phases and their reuse by every engine."""
+import pytest
+
+import EventSimulation as es
+import GlobalFunctions as gl
+import IncrementalEvaluation as ie
+
+
+def _per_second_layout(schedule, intersection, yellow_phase, duration_to_pass):
+    """The green street of every second of the cycle, laid out one second at a time."""
+    if len(schedule.order) == 1:
+        # a single street stays green
+        return [schedule.order[0]]
+    usage_factor = 1 / duration_to_pass
+    seconds = []
+    for street_id in schedule.order:
+        green_time = schedule.green_times[street_id]
+        green_time_usage = max(0, int(usage_factor * (green_time - yellow_phase)))
+        seconds += [street_id] * green_time_usage + [-1] * max(0, green_time - green_time_usage)
+    cycle = sum(schedule.green_times[street_id] for street_id in schedule.order)
+    cycle += intersection.pedestrian_phase_interval + intersection.all_red_phase_interval
+    seconds += [-1] * cycle
+    return seconds[:cycle]
+
+
+@pytest.mark.parametrize('yellow_phase, duration_to_pass', [(None, None), (7, 1), (2, 0.6)])
+def test_green_seconds(grade_args, schedules, yellow_phase, duration_to_pass):
+    _, intersections, _, _, _, yellow_phase, duration_to_pass = grade_args(yellow_phase=yellow_phase,
+                                                                           duration_to_pass=duration_to_pass)
+    for schedule in schedules[0]:
+        intersection = intersections[schedule.i_intersection]
+        table = gl.compile_phase_table(schedule, intersection, yellow_phase, duration_to_pass)
+        # network objects reference each other, keep them out of assertion messages
+        layout = _per_second_layout(schedule, intersection, yellow_phase, duration_to_pass)
+        assert list(table.green) == layout
+
+
+@pytest.mark.parametrize('yellow_phase, duration_to_pass', [(None, None), (7, 1), (2, 0.6), (30, 1)])
+def test_phases(grade_args, schedules, yellow_phase, duration_to_pass):
+    # The phases cover the cycle like the green seconds, with the signal groups of the green streets.
+    _, intersections, _, _, _, yellow_phase, duration_to_pass = grade_args(yellow_phase=yellow_phase,
+                                                                           duration_to_pass=duration_to_pass)
+    for schedule in schedules[0]:
+        intersection = intersections[schedule.i_intersection]
+        table = gl.compile_phase_table(schedule, intersection, yellow_phase, duration_to_pass)
+        assert table.starts[0] == 0
+        ends = list(table.starts[1:]) + [table.cycle]
+        for start, end, street_id, released in zip(table.starts, ends, table.street_ids, table.released):
+            assert start < end
+            assert set(table.green[start:end]) == {street_id}
+            assert released == (intersection.signal_groups.get(street_id, (street_id,)) if street_id >= 0 else ())
+
+
+def test_tables_are_shared(grade_args, schedules):
+    _, intersections, _, _, _, yellow_phase, duration_to_pass = grade_args()
+    parent, child = schedules[0], schedules[1].copy()
+    shared = 0
+    for parent_schedule, child_schedule in zip(parent, child):
+        intersection = intersections[parent_schedule.i_intersection]
+        parent_table = gl.compile_phase_table(parent_schedule, intersection, yellow_phase, duration_to_pass)
+        child_table = gl.compile_phase_table(child_schedule, intersection, yellow_phase, duration_to_pass)
+        if list(parent_schedule.order) == list(child_schedule.order) and \
+                all(parent_schedule.green_times[s] == child_schedule.green_times[s] for s in parent_schedule.order):
+            assert child_table is parent_table
+            shared += 1
+    assert shared > 0
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'event'])
+@pytest.mark.parametrize('yellow_phase, duration_to_pass', [(7, 1), (2, 0.6), (30, 1)])
+def test_engines_agree_on_other_timings(grade_args, schedules, engine, yellow_phase, duration_to_pass):
+    # Every engine reads the same tables, a yellow phase longer than green times included.
+    args = grade_args(yellow_phase=yellow_phase, duration_to_pass=duration_to_pass)
+    for schedule in schedules[:3]:
+        assert gl.grade(schedule, *args, engine=engine) == gl.grade(schedule, *args)
+
+
+def test_first_difference(grade_args, schedules):
+    streets, intersections, paths, total_duration, bonus_points, yellow_phase, duration_to_pass = grade_args()
+    network = es.compile_network(streets, intersections, paths)
+    for parent_schedule, child_schedule in zip(schedules[0], schedules[-1]):
+        parent = es.compile_phases(parent_schedule, network, yellow_phase, duration_to_pass)
+        child = es.compile_phases(child_schedule, network, yellow_phase, duration_to_pass)
+        seconds = [t for t in range(total_duration)
+                   if parent.green[t % parent.cycle] != child.green[t % child.cycle]]
+        assert ie._first_difference(parent, child, total_duration) == (seconds[0] if seconds else None)